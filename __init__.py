@@ -1,5 +1,12 @@
 #!/usr/bin/env python
 
+import approximate
+import dense
+import frozen
+import journal
 import limited_types
+import metrics
 import prefix_sql
+import random_streams
 import tree
+import tuple_map
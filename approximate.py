@@ -0,0 +1,162 @@
+#!/usr/bin/python
+
+"""Approximate-count training for very large corpora.
+
+An ApproximateTrainer sits in front of a tree.MarkovChain or a
+prefix_sql.MarkovPrefixSql and counts every tuple in a fixed size count-min
+sketch first.  A tuple only becomes part of the exact model once its
+estimated count reaches the promotion threshold, at which point the
+estimated count is credited to it, and from then on every occurrence goes
+straight to the exact model.  Rare tuples, which make up most of the
+distinct tuples in natural text, never take up space in the model.
+
+Whether a tuple has been promoted is looked up in the exact model itself,
+so the trainer's own memory stays fixed at the size of the sketch.
+"""
+
+from array import array
+import math
+
+
+class CountMinSketch(object):
+  """A count-min sketch with conservative update.
+
+  Estimates are never below the true count, and with probability 1-delta
+  they exceed it by no more than epsilon times the total count added.
+  """
+
+  def __init__(self, epsilon=0.0001, delta=0.01):
+    """Build a new, empty sketch.
+
+    Arguments:
+      epsilon: relative error bound, as a fraction of the total count.
+      delta: probability of an estimate exceeding the error bound.
+    """
+    if not 0 < epsilon < 1 or not 0 < delta < 1:
+      raise ValueError('epsilon and delta must be between 0 and 1')
+    self.width = int(math.ceil(math.e / epsilon))
+    self.depth = int(math.ceil(math.log(1.0 / delta)))
+    self.total = 0
+    self._rows = [array('L', [0]) * self.width for _ in xrange(self.depth)]
+
+  def _Cells(self, key):
+    # double hashing gives depth hash functions for the price of two
+    first = hash(key)
+    second = hash((key, 0x5bd1e995))
+    return [(first + row * second) % self.width for row in xrange(self.depth)]
+
+  def Add(self, key, count=1):
+    """Adds count occurrences of key, and returns the new estimate."""
+    cells = self._Cells(key)
+    estimate = min(row[cell] for row, cell in zip(self._rows, cells)) + count
+    for row, cell in zip(self._rows, cells):
+      if row[cell] < estimate:
+        row[cell] = estimate
+    self.total += count
+    return estimate
+
+  def Estimate(self, key):
+    """Returns the estimated number of occurrences of key."""
+    return min(row[cell] for row, cell in zip(self._rows, self._Cells(key)))
+
+
+class ApproximateTrainer(object):
+  """Trains a chain, only keeping exact counts for frequent tuples.
+
+  Labels and, for prefix chains, initial tuples are only recorded from the
+  occurrence that promotes a tuple onwards.
+  """
+
+  def __init__(self, chain, threshold=2, epsilon=0.0001, delta=0.01,
+               sketch=None):
+    """Build a new trainer.
+
+    Arguments:
+      chain: a tree.MarkovChain or prefix_sql.MarkovPrefixSql to train.
+      threshold: estimated count at which a tuple is promoted into chain.
+      epsilon, delta: error bounds for the sketch, see CountMinSketch.
+      sketch: (optional) a sketch to use instead of building a new one.
+    """
+    self.chain = chain
+    self.threshold = threshold
+    if sketch is None:
+      sketch = CountMinSketch(epsilon, delta)
+    self.sketch = sketch
+    self._promoted = 0
+
+  def _InChain(self, t):
+    """Returns whether the exact model already holds t.
+
+    For a tree, a tuple shorter than max counts as held once its node
+    exists, even if the node is only there for longer tuples.
+    """
+    chain = self.chain
+    if hasattr(chain, '_updateTuple'):
+      if len(t) >= chain._max:
+        leaf = t[chain._max-1]
+      else:
+        leaf = chain._separator
+      prefix_id = chain._getPrefixId(t[:chain._max-1])
+      return (prefix_id is not None and
+              chain._getLeafId(prefix_id, leaf) is not None)
+
+    node = chain
+    for element in t:
+      node = node.get(element)
+      if node is None:
+        return False
+    return True
+
+  def _Observe(self, t):
+    """Counts one occurrence of t.
+
+    Returns:
+      The count to add to the exact model, which is 0 if t hasn't been
+      promoted yet.
+    """
+    if self._InChain(t):
+      return 1
+    estimate = self.sketch.Add(t)
+    if estimate < self.threshold:
+      return 0
+    self._promoted += 1
+    return estimate
+
+  def Update(self, seq, label=None):
+    """Updates from a tuple or list, like the chain's own Update()."""
+    if hasattr(self.chain, '_updateTuple'):
+      return self._UpdatePrefixChain(seq, label)
+
+    chain = self.chain
+    for ind in xrange(len(seq)-chain._min+1):
+      t = tuple(seq[ind:ind+chain._max])
+      count = self._Observe(t)
+      if count:
+        chain._UpdateTuple(t, label=label, count=count)
+
+  def _UpdatePrefixChain(self, seq, label):
+    chain = self.chain
+    if label is not None and chain._ignore_dupes and chain._isLabelSeen(label):
+      return 0
+
+    subseq = list(seq[:chain._max-1])
+    initial = True
+    for element in seq[chain._max-1:]:
+      subseq.append(element)
+      count = self._Observe(tuple(subseq))
+      if count:
+        chain._updateTuple(subseq, label, initial, count)
+      subseq = subseq[1:]
+      initial = False
+
+    count = self._Observe(tuple(subseq))
+    if count:
+      chain._updateTuple(subseq, label, initial, count)
+    if label is not None:
+      chain._markLabelSeen(label)
+    chain._commit()
+    return 1
+
+  def PromotedCount(self):
+    """Returns the number of tuples this trainer promoted."""
+    return self._promoted
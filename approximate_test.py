@@ -0,0 +1,48 @@
+#!/usr/bin/python
+
+import unittest
+
+from approximate import ApproximateTrainer
+from approximate import CountMinSketch
+from prefix_sql import MarkovPrefixSql
+from tree import MarkovChain
+
+class CountMinSketchTest(unittest.TestCase):
+  def testNeverUnderestimates(self):
+    sketch = CountMinSketch(epsilon=0.05, delta=0.1)
+    for i in xrange(1000):
+      sketch.Add(('word', i % 37))
+    for i in xrange(37):
+      self.assertTrue(sketch.Estimate(('word', i)) >= 1000 // 37,
+                      "Estimate below the true count for %d" % i)
+    self.assertEqual(1000, sketch.total)
+
+class ApproximateTrainerTest(unittest.TestCase):
+  def testOnlyFrequentTuplesPromoted(self):
+    mc = MarkovChain(max=2, min=2)
+    trainer = ApproximateTrainer(mc, threshold=3)
+    for _ in xrange(5):
+      trainer.Update('ab')
+    trainer.Update('xy')
+    self.assertTrue('a' in mc, "Frequent tuple wasn't promoted")
+    self.assertFalse('x' in mc, "Rare tuple was promoted")
+    self.assertEqual(5, mc['a']['b'].count,
+                     "Promoted tuple should carry its full count")
+    self.assertEqual(1, trainer.PromotedCount())
+
+  def testPrefixChain(self):
+    chain = MarkovPrefixSql(max=2)
+    trainer = ApproximateTrainer(chain, threshold=2)
+    trainer.Update(['a', 'b'])
+    self.assertEqual(None, chain._getPrefixId(['a']))
+    trainer.Update(['a', 'b'])
+    self.assertNotEqual(None, chain._getPrefixId(['a']))
+    self.assertEqual(('a', 'b'), chain.GetRandomTuple(['a']))
+    trainer.Update(['a', 'b'])
+    self.assertEqual([('b', 3)], chain.GetTopK(['a'], 1),
+                     "Promoted tuples should be counted exactly")
+    # ('a', 'b') and the end of the sequence, ('b',)
+    self.assertEqual(2, trainer.PromotedCount())
+
+if __name__ == "__main__":
+  unittest.main()
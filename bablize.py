@@ -2,40 +2,198 @@
 
 # Copyright 2009, Mitch Patenaude
 
+from markov.random_streams import stream
 from markov.tuple_map import MarkovChain
+import argparse
+import cPickle
+import mmap
+import multiprocessing
+import os
+import random
 import sys
 
-def bablize(infile,outfile,depth=5):
-  mkv = MarkovChain(max=depth)
+# Bytes of output collected before each write.
+WRITE_BUFFER_SIZE = 1 << 20
+
+def paragraphs(lines):
+  """Yields the words of each blank line separated paragraph in lines."""
   para = []
-  firsts = []
-  for line in infile:
+  for line in lines:
     if line.isspace():
       if para:
-        firsts.append(tuple(para[0:mkv._max-1]))
-        mkv.Update(para)
+        yield para
         para = []
     else:
-      para += line.split()
-
+      para.extend(line.split())
   if para:
+    yield para
+
+def train(paras, depth=5):
+  """Returns a chain trained on paras, and the seed for each paragraph."""
+  mkv = MarkovChain(max=depth)
+  firsts = []
+  for para in paras:
     firsts.append(tuple(para[0:mkv._max-1]))
     mkv.Update(para)
+  return mkv, firsts
+
+def _chunk_bounds(data, count):
+  """Splits data into about count chunks that end on paragraph breaks."""
+  bounds = []
+  start = 0
+  for ind in xrange(1, count):
+    end = data.find('\n\n', max(start, len(data) * ind // count))
+    if end < 0:
+      break
+    bounds.append((start, end + 2))
+    start = end + 2
+  bounds.append((start, len(data)))
+  return bounds
+
+def _mapped_lines(data, start, end):
+  """Yields the lines of data from start up to end, without copying the rest."""
+  data.seek(start)
+  while data.tell() < end:
+    yield data.readline()
+
+def _train_chunk(args):
+  filename, start, end, depth = args
+  with open(filename, 'rb') as fh:
+    data = mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ)
+    try:
+      return train(paragraphs(_mapped_lines(data, start, end)), depth)
+    finally:
+      data.close()
+
+def train_file(filename, depth=5, workers=1):
+  """Trains on a file, tokenizing and training in worker processes.
+
+  The file is memory mapped and split on paragraph breaks, and the chains
+  for the chunks are merged in order, so the result is the same for any
+  number of workers.
+  """
+  if os.path.getsize(filename) == 0:
+    # an empty file can't be mapped
+    return train([], depth)
+  with open(filename, 'rb') as fh:
+    data = mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ)
+    try:
+      bounds = _chunk_bounds(data, workers)
+    finally:
+      data.close()
+
+  jobs = [(filename, start, end, depth) for start, end in bounds]
+  if workers > 1:
+    pool = multiprocessing.Pool(workers)
+    try:
+      results = pool.map(_train_chunk, jobs)
+    finally:
+      pool.close()
+      pool.join()
+  else:
+    results = [_train_chunk(job) for job in jobs]
+
+  mkv, firsts = results[0]
+  for chunk_mkv, chunk_firsts in results[1:]:
+    mkv.Merge(chunk_mkv)
+    firsts.extend(chunk_firsts)
+  return mkv, firsts
+
+def save_model(filename, mkv, firsts):
+  with open(filename, 'wb') as fh:
+    cPickle.dump((mkv, firsts), fh, cPickle.HIGHEST_PROTOCOL)
+
+def load_model(filename):
+  """Returns the (chain, paragraph seeds) saved by save_model()."""
+  with open(filename, 'rb') as fh:
+    return cPickle.load(fh)
+
+# The chain used by generation workers, inherited when they're forked.
+_generator_chain = None
+
+def _generate_one(args):
+  index, seed, rng_seed = args
+  if rng_seed is None:
+    rng = None
+  else:
+    rng = stream(rng_seed, index)
+  return " ".join(_generator_chain.GetRandomSequence(seed=seed, rng=rng))+"\n\n"
+
+def _reseed():
+  # forked workers would otherwise all share the parent's random state
+  random.seed()
+
+def generate(mkv, firsts, outfile, rng_seed=None, workers=1):
+  """Writes a generated paragraph for each seed in firsts to outfile.
+
+  With an rng_seed, each paragraph gets its own random stream, so the output
+  is the same for any number of workers.
+  """
+  global _generator_chain
+  _generator_chain = mkv
+  jobs = ((index, seed, rng_seed) for index, seed in enumerate(firsts))
+  pool = None
+  if workers > 1:
+    pool = multiprocessing.Pool(workers, initializer=_reseed)
+    results = pool.imap(_generate_one, jobs, chunksize=64)
+  else:
+    results = (_generate_one(job) for job in jobs)
+
+  try:
+    buffered = []
+    buffered_size = 0
+    for text in results:
+      buffered.append(text)
+      buffered_size += len(text)
+      if buffered_size >= WRITE_BUFFER_SIZE:
+        outfile.write(''.join(buffered))
+        buffered = []
+        buffered_size = 0
+    outfile.write(''.join(buffered))
+  finally:
+    if pool is not None:
+      pool.close()
+      pool.join()
+
+def bablize(infile,outfile,depth=5,rng_seed=None,workers=1):
+  mkv, firsts = train(paragraphs(infile), depth)
 
   # we shouldn't close a file that we didn't open.
   # infile.close()
 
-  for seed in firsts:
-    outfile.write(" ".join(mkv.GetRandomSequence(seed=seed))+"\n\n")
+  generate(mkv, firsts, outfile, rng_seed, workers)
   # we shouldn't close a file that we didn't open.
   # outfile.close()
 
-if __name__ == '__main__':
-  if sys.argv and sys.argv[0].isdigit():
-    depth=int(sys.argv[0])
+def main(argv):
+  parser = argparse.ArgumentParser(
+      description='Babble paragraphs that sound like the input.')
+  parser.add_argument('depth', nargs='?', type=int, default=5,
+                      help='length of tuples in the chain (default 5)')
+  parser.add_argument('--input', help='read this file, memory mapped, '
+                      'instead of stdin')
+  parser.add_argument('--workers', type=int, default=1,
+                      help='processes to train (with --input) and generate with')
+  parser.add_argument('--seed', type=int, help='random seed, for '
+                      'reproducible output')
+  parser.add_argument('--save-model', help='save the trained model here')
+  parser.add_argument('--load-model', help='generate from a saved model '
+                      'instead of training')
+  parser.add_argument('--train-only', action='store_true',
+                      help='don\'t generate any output')
+  args = parser.parse_args(argv)
+
+  if args.load_model:
+    mkv, firsts = load_model(args.load_model)
+  elif args.input:
+    mkv, firsts = train_file(args.input, args.depth, args.workers)
   else:
-    depth=5
+    mkv, firsts = train(paragraphs(sys.stdin), args.depth)
 
-  bablize(sys.stdin, sys.stdout, depth)
+  if args.save_model:
+    save_model(args.save_model, mkv, firsts)
+  if not args.train_only:
+    generate(mkv, firsts, sys.stdout, args.seed, args.workers)
 
-  
+if __name__ == '__main__':
+  main(sys.argv[1:])
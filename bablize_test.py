@@ -0,0 +1,64 @@
+#!/usr/bin/python
+
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import unittest
+
+_CHECKOUT = os.path.dirname(os.path.abspath(__file__))
+
+TEXT = """the cat sat on the mat and the dog sat on the log
+while the bird sang
+
+the dog chased the cat off the mat
+and the cat ran up the tree
+
+the bird sat on the tree and sang to the cat
+and the dog sat on the mat
+
+"""
+
+class BablizeTest(unittest.TestCase):
+  def setUp(self):
+    self.tmpdir = tempfile.mkdtemp()
+    self.input = os.path.join(self.tmpdir, 'input.txt')
+    with open(self.input, 'wb') as fh:
+      fh.write(TEXT * 20)
+    # bablize imports the markov package, whatever the checkout is called
+    self.path = os.path.join(self.tmpdir, 'path')
+    os.mkdir(self.path)
+    os.symlink(_CHECKOUT, os.path.join(self.path, 'markov'))
+
+  def tearDown(self):
+    shutil.rmtree(self.tmpdir)
+
+  def _Run(self, args, stdin=''):
+    env = dict(os.environ, PYTHONPATH=self.path)
+    proc = subprocess.Popen(
+        [sys.executable, '-m', 'markov.bablize', '3', '--seed', '7'] + args, stdin=subprocess.PIPE, stdout=subprocess.PIPE, env=env)
+    output, _ = proc.communicate(stdin)
+    self.assertEqual(0, proc.returncode)
+    return output
+
+  def testSameOutput(self):
+    expected = self._Run([], stdin=TEXT * 20)
+    self.assertEqual(60, expected.count('\n\n'))
+    self.assertEqual(expected, self._Run(['--input', self.input]))
+    self.assertEqual(expected, self._Run(['--input', self.input,
+                                          '--workers', '3']))
+    model = os.path.join(self.tmpdir, 'model')
+    self.assertEqual(expected, self._Run(['--input', self.input,
+                                          '--save-model', model]))
+    self.assertEqual(expected, self._Run(['--load-model', model,
+                                          '--workers', '2']))
+
+  def testEmptyInput(self):
+    with open(self.input, 'wb'):
+      pass
+    self.assertEqual('', self._Run(['--input', self.input]))
+    self.assertEqual('', self._Run([]))
+
+if __name__ == "__main__":
+  unittest.main()
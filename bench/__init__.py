@@ -0,0 +1,11 @@
+#!/usr/bin/env python
+
+"""Benchmarks for the markov chain backends.
+
+Run them with:
+  python -m markov.bench.runner --output results.json
+and compare a later run against it with:
+  python -m markov.bench.runner --baseline results.json
+"""
+
+import corpus
@@ -0,0 +1,46 @@
+#!/usr/bin/python
+
+"""Deterministic synthetic corpora for benchmarks.
+
+Word frequencies follow a Zipf distribution, like natural text, so the
+chains get the same mix of a few very busy contexts and a long tail of rare
+ones.  The same arguments always give the same corpus.
+"""
+
+import bisect
+import random
+
+
+def vocabulary(size):
+  """Returns size distinct words, most frequent first."""
+  return ['w%d' % rank for rank in xrange(size)]
+
+
+def zipf_corpus(num_words=100000, vocab_size=5000, exponent=1.1,
+                mean_length=50, seed=0):
+  """Returns a list of sequences of words, num_words words in all.
+
+  Arguments:
+    num_words: total number of words in the corpus.
+    vocab_size: number of distinct words.
+    exponent: Zipf exponent; the word of rank r has weight 1/r**exponent.
+    mean_length: average sequence length.  Lengths are uniform between 1 and
+      2*mean_length-1.
+    seed: random seed.
+  """
+  rnd = random.Random(seed)
+  words = vocabulary(vocab_size)
+  cumulative = []
+  total = 0.0
+  for rank in xrange(1, vocab_size+1):
+    total += 1.0 / rank ** exponent
+    cumulative.append(total)
+
+  seqs = []
+  remaining = num_words
+  while remaining > 0:
+    length = min(remaining, rnd.randint(1, 2*mean_length-1))
+    seqs.append([words[bisect.bisect(cumulative, rnd.random() * total)]
+                 for _ in xrange(length)])
+    remaining -= length
+  return seqs
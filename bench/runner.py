@@ -0,0 +1,321 @@
+#!/usr/bin/python
+
+"""Measures ingest throughput, generation latency and memory of each backend.
+
+Each backend is measured in its own forked process, so that its peak RSS
+isn't mixed up with any other backend's.  Results are written as JSON, and
+can be compared against a saved baseline:
+
+  python -m markov.bench.runner --output baseline.json
+  python -m markov.bench.runner --baseline baseline.json
+"""
+
+import argparse
+import json
+import multiprocessing
+import os
+import platform
+import random
+import resource
+import shutil
+import sys
+import tempfile
+import time
+
+from markov import dense
+from markov import prefix_sql
+from markov import tree
+from markov import tuple_map
+from markov.bench import corpus
+
+# Most counters the dense backend may allocate when it's benchmarked.  Each
+# node with children gets a row of vocab counters, so this is 1 GiB of 32 bit
+# counters, however they're split between rows.
+DENSE_MAX_COUNTERS = 2**28
+
+# Generated sequences are cut off at this many elements.
+MAX_SEQUENCE_LENGTH = 1000
+
+# For each metric, whether a bigger number is better.  Anything not listed
+# is informational and never counts as a regression.
+HIGHER_IS_BETTER = {
+    'update_tokens_per_sec': True,
+    'generate_tokens_per_sec': True,
+    'generate_p50_us': False,
+    'generate_p99_us': False,
+    'partial_seed_ops_per_sec': True,
+    'initial_seed_ops_per_sec': True,
+    'annotated_tokens_per_sec': True,
+    'peak_rss_kb': False,
+    'bytes_per_tuple': False,
+}
+
+
+def _rss_bytes():
+  with open('/proc/self/statm') as fh:
+    return int(fh.read().split()[1]) * resource.getpagesize()
+
+
+def _percentile(sorted_values, fraction):
+  if not sorted_values:
+    return 0.0
+  return sorted_values[min(len(sorted_values)-1,
+                           int(fraction * len(sorted_values)))]
+
+
+def _stored_tuples(chain):
+  """Returns the number of distinct full length tuples chain holds.
+
+  The ends of sequences, which some backends store as tuples of their own,
+  aren't counted, so that every backend is measured against the same number.
+  """
+  if isinstance(chain, prefix_sql.MarkovPrefixSql):
+    for row in chain._cursor.execute(
+        'SELECT count(*) FROM leaves WHERE suffix != ?;', [chain._separator]):
+      return row[0]
+  if isinstance(chain, tuple_map.MarkovChain):
+    return sum(1 for successors in chain._contexts.itervalues()
+               for element in successors.elements
+               if element is not tuple_map._END)
+  if isinstance(chain, dense.MarkovChain):
+    return sum(1 for count in chain._counts[chain._max] if count)
+
+  stored = 0
+  stack = [(chain, 0)]
+  while stack:
+    node, depth = stack.pop()
+    if depth == chain._max - 1:
+      stored += len(node)
+    else:
+      stack.extend((child, depth+1) for child in node.itervalues())
+  return stored
+
+
+def _dense_rows(seqs, depth):
+  """Returns how many rows of counters a dense chain trained on seqs needs.
+
+  That's one for each distinct tuple of fewer than depth elements that's
+  followed by another element, counting the empty tuple at the root.
+  """
+  parents = set([()])
+  for seq in seqs:
+    for length in xrange(1, depth):
+      for ind in xrange(len(seq) - length):
+        parents.add(tuple(seq[ind:ind+length]))
+  return len(parents)
+
+
+def _dense_skip_reason(args, seqs):
+  """Returns why the dense backend can't be measured, or None if it can."""
+  if args.vocab ** args.max > dense._MAX_CODES:
+    return 'vocab**max is more than a dense chain can code'
+  counters = _dense_rows(seqs, args.max) * args.vocab
+  if counters > DENSE_MAX_COUNTERS:
+    return '{} counters would be more than DENSE_MAX_COUNTERS'.format(counters)
+  return None
+
+
+def _backends(args, seqs, tmpdir, skipped):
+  """Returns (name, factory, database file) for the backends to measure.
+
+  Backends that can't be measured with args are left out, and added to
+  skipped with the reason.
+  """
+  dbfile = os.path.join(tmpdir, 'bench.db')
+  backends = [
+      ('tree', lambda: tree.MarkovChain(max=args.max), None),
+      ('tuple_map', lambda: tuple_map.MarkovChain(max=args.max), None),
+      ('prefix_sql_memory',
+       lambda: prefix_sql.MarkovPrefixSql(max=args.max), None),
+      ('prefix_sql_file',
+       lambda: prefix_sql.MarkovPrefixSql(max=args.max, dbfile=dbfile),
+       dbfile),
+  ]
+  reason = _dense_skip_reason(args, seqs)
+  if reason is None:
+    backends.append(('dense', lambda: dense.MarkovChain(
+        max=args.max, alphabet_size=args.vocab), None))
+  elif not args.backends or 'dense' in args.backends:
+    skipped['dense'] = reason
+  return [backend for backend in backends
+          if not args.backends or backend[0] in args.backends]
+
+
+def measure(factory, seqs, args, dbfile=None):
+  """Trains a chain from factory on seqs, and returns its measurements.
+
+  Arguments:
+    factory: makes the chain to measure.
+    seqs: the corpus.
+    args: the parsed command line.
+    dbfile: the database file the chain uses, if any.  Its size, rather than
+      the growth in RSS, is used for bytes_per_tuple.
+  """
+  results = {}
+  rss_before = _rss_bytes()
+  chain = factory()
+
+  tokens = sum(len(seq) for seq in seqs)
+  start = time.time()
+  for seq in seqs:
+    chain.Update(seq)
+  results['update_tokens_per_sec'] = tokens / (time.time() - start)
+  results['stored_tuples'] = _stored_tuples(chain)
+  if dbfile is not None:
+    size = sum(os.path.getsize(path) for path in (dbfile, dbfile + '-wal')
+               if os.path.exists(path))
+  else:
+    size = _rss_bytes() - rss_before
+  results['bytes_per_tuple'] = float(size) / max(1, results['stored_tuples'])
+
+  rng = random.Random(args.seed)
+  seeds = [seq[:args.max-1] for seq in seqs[:args.generate]]
+
+  latencies = []
+  start = time.time()
+  for seed in seeds:
+    sequence = iter(chain.GetRandomSequence(seed, rng=rng))
+    for _ in xrange(MAX_SEQUENCE_LENGTH):
+      step_start = time.time()
+      try:
+        next(sequence)
+      except StopIteration:
+        break
+      latencies.append(time.time() - step_start)
+  elapsed = time.time() - start
+  latencies.sort()
+  results['generate_tokens_per_sec'] = len(latencies) / elapsed
+  results['generate_p50_us'] = _percentile(latencies, 0.50) * 1e6
+  results['generate_p99_us'] = _percentile(latencies, 0.99) * 1e6
+
+  start = time.time()
+  for seed in seeds:
+    chain.GetRandomTuple(seed[:1], rng=rng)
+  results['partial_seed_ops_per_sec'] = len(seeds) / (time.time() - start)
+
+  initial = getattr(chain, 'GetInitialRandomTuple', chain.GetRandomTuple)
+  start = time.time()
+  for _ in seeds:
+    initial(rng=rng)
+  results['initial_seed_ops_per_sec'] = len(seeds) / (time.time() - start)
+
+  annotated = 0
+  start = time.time()
+  for seed in seeds:
+    for _ in zip(xrange(MAX_SEQUENCE_LENGTH),
+                 chain.GetAnnotatedSequence(seed, rng=rng)):
+      annotated += 1
+  results['annotated_tokens_per_sec'] = annotated / (time.time() - start)
+
+  results['peak_rss_kb'] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+  return results
+
+
+def _measure_in_child(factory, seqs, args, dbfile, queue):
+  try:
+    queue.put(measure(factory, seqs, args, dbfile))
+  except Exception as e:
+    queue.put({'error': repr(e)})
+
+
+def run(args):
+  """Runs every benchmark, and returns the results as a dict."""
+  seqs = corpus.zipf_corpus(num_words=args.words, vocab_size=args.vocab,
+                            exponent=args.exponent, seed=args.seed)
+  report = {
+      'config': {
+          'words': args.words,
+          'vocab': args.vocab,
+          'exponent': args.exponent,
+          'max': args.max,
+          'generate': args.generate,
+          'seed': args.seed,
+      },
+      'python': platform.python_version(),
+      'backends': {},
+      # backends that weren't measured, with the reason
+      'skipped': {},
+  }
+
+  tmpdir = tempfile.mkdtemp(prefix='markov-bench-')
+  try:
+    for name, factory, dbfile in _backends(args, seqs, tmpdir,
+                                           report['skipped']):
+      queue = multiprocessing.Queue()
+      child = multiprocessing.Process(target=_measure_in_child,
+                                      args=(factory, seqs, args, dbfile, queue))
+      child.start()
+      report['backends'][name] = queue.get()
+      child.join()
+      sys.stderr.write('{}: {}\n'.format(name, report['backends'][name]))
+  finally:
+    shutil.rmtree(tmpdir)
+  return report
+
+
+def compare(results, baseline, tolerance):
+  """Compares results with a baseline.
+
+  Returns:
+    A list of (backend, metric, baseline value, new value, regressed)
+    tuples, where regressed means the metric got worse by more than the
+    tolerance, given as a fraction.
+  """
+  comparisons = []
+  for name, metrics in sorted(results['backends'].items()):
+    old_metrics = baseline.get('backends', {}).get(name, {})
+    for metric, higher_is_better in sorted(HIGHER_IS_BETTER.items()):
+      if metric not in metrics or metric not in old_metrics:
+        continue
+      old, new = old_metrics[metric], metrics[metric]
+      if higher_is_better:
+        regressed = new < old * (1 - tolerance)
+      else:
+        regressed = new > old * (1 + tolerance)
+      comparisons.append((name, metric, old, new, regressed))
+  return comparisons
+
+
+def main(argv):
+  parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+  parser.add_argument('--words', type=int, default=100000,
+                      help='corpus size in words')
+  parser.add_argument('--vocab', type=int, default=5000,
+                      help='number of distinct words')
+  parser.add_argument('--exponent', type=float, default=1.1,
+                      help='Zipf exponent of the word frequencies')
+  parser.add_argument('--max', type=int, default=3, help='chain max')
+  parser.add_argument('--generate', type=int, default=200,
+                      help='number of sequences to generate')
+  parser.add_argument('--seed', type=int, default=0, help='random seed')
+  parser.add_argument('--backends', nargs='*',
+                      help='only run these backends')
+  parser.add_argument('--output', help='write the results here as JSON')
+  parser.add_argument('--baseline', help='compare with these saved results')
+  parser.add_argument('--tolerance', type=float, default=0.1,
+                      help='allowed fractional regression (default 0.1)')
+  args = parser.parse_args(argv)
+
+  results = run(args)
+  if args.output:
+    with open(args.output, 'w') as fh:
+      json.dump(results, fh, indent=2, sort_keys=True)
+  else:
+    json.dump(results, sys.stdout, indent=2, sort_keys=True)
+    sys.stdout.write('\n')
+
+  if args.baseline:
+    with open(args.baseline) as fh:
+      baseline = json.load(fh)
+    regressions = 0
+    for name, metric, old, new, regressed in compare(
+        results, baseline, args.tolerance):
+      sys.stderr.write('{:20} {:26} {:14.1f} -> {:14.1f}{}\n'.format(
+          name, metric, old, new, '  REGRESSION' if regressed else ''))
+      regressions += regressed
+    return 1 if regressions else 0
+  return 0
+
+
+if __name__ == '__main__':
+  sys.exit(main(sys.argv[1:]))
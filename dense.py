@@ -0,0 +1,348 @@
+#!/usr/bin/python
+
+"""A dense array representation of a markov chain for small alphabets.
+
+Character or byte level chains have so few distinct elements that the
+dict-of-dicts tree spends most of its time and memory on per-node overhead.
+This implementation maps each element to a small integer, and identifies a
+tuple of length d by its code, the tuple read as a base alphabet_size
+number.  The children of a node are one row of alphabet_size counters.  Rows
+are only allocated once the node has a child, in one growing array per
+depth, so memory grows with the number of distinct contexts seen rather
+than with alphabet_size**max.
+
+NumPy is used when it is available, so that updates are vectorized over the
+whole input sequence.  Otherwise the counts are kept in array('I') objects.
+"""
+
+from array import array
+import bisect
+import random
+
+try:
+  import numpy
+except ImportError:
+  numpy = None
+
+from random_streams import get_rng
+
+# Codes are held in 64 bit integers, so alphabet_size**max must fit in one.
+_MAX_CODES = 2**63
+
+
+class MarkovChain(object):
+  """A markov chain over a small alphabet, backed by dense count arrays.
+
+  This has the same interface as tree.MarkovChain, but the number of distinct
+  elements is limited to alphabet_size, and every node with children uses
+  alphabet_size counters, however few children it has.
+  """
+
+  def __init__(self, max=3, min=None, alphabet_size=256, alphabet=None):
+    """Build a new dense Markov chain object.
+
+    Arguments:
+      max: maximum length of tuple to keep stats for. (optional, default = 3)
+      min: minimum length of tuple about which statistics will be updated by
+        the Update() method.  See tree.MarkovChain.
+      alphabet_size: the maximum number of distinct elements. (default = 256)
+      alphabet: (optional) elements to assign indexes to up front, in order.
+
+    Raises:
+      ValueError: if min > max, or alphabet_size**max is too large.
+    """
+    self.count = 0
+    self._max = max
+    if min is None:
+      min = max-1
+    elif min > max:
+      raise ValueError("minimum tuple size cannot exceed maximum")
+    self._min = min
+    self.labels = set()
+
+    if alphabet_size ** max > _MAX_CODES:
+      raise ValueError('alphabet_size**max is too large for a dense chain')
+    self._size = alphabet_size
+    self._elements = []
+    self._index = {}
+    # for each depth, the row of each parent code, and the rows of counters
+    self._rows = [None] + [{} for _ in xrange(max)]
+    self._counts = [None] + [self._Zeros(0) for _ in xrange(max)]
+    # labels are sparse, so they're kept by (depth, code) rather than densely
+    self._labels = {}
+    # cumulative child counts by (depth, code), cleared on every update
+    self._cumulative = {}
+
+    if alphabet:
+      for element in alphabet:
+        self._Index(element)
+
+  @staticmethod
+  def _Zeros(size):
+    if numpy is not None:
+      return numpy.zeros(size, dtype=numpy.uint32)
+    return array('I', [0]) * size
+
+  def _Row(self, depth, parent):
+    """Returns the row of counters for the children of parent, creating it
+    if needed."""
+    rows = self._rows[depth]
+    row = rows.get(parent)
+    if row is None:
+      row = rows[parent] = len(rows)
+      counts = self._counts[depth]
+      needed = len(rows) * self._size
+      if len(counts) < needed:
+        if numpy is not None:
+          # doubled, so that the copies add up to linear time
+          grown = numpy.zeros(max(needed, 2 * len(counts)), dtype=numpy.uint32)
+          grown[:len(counts)] = counts
+          self._counts[depth] = grown
+        else:
+          counts.extend(self._Zeros(self._size))
+    return row
+
+  def _Index(self, element):
+    """Returns the index of element, assigning a new one if needed."""
+    ind = self._index.get(element)
+    if ind is None:
+      ind = len(self._elements)
+      if ind >= self._size:
+        raise ValueError('More than {} distinct elements in a dense chain'
+                         .format(self._size))
+      self._index[element] = ind
+      self._elements.append(element)
+    return ind
+
+  def Update(self, seq, label=None):
+    """Updates from a tuple, list or string, but not an iterator.
+
+    Every depth is updated with one vectorized pass over the sequence: the
+    codes of the windows of length d are derived from those of length d-1.
+    """
+    seq_len = len(seq)
+    num_tuples = seq_len - self._min + 1
+    if num_tuples <= 0:
+      return
+
+    indexes = [self._Index(element) for element in seq]
+    self.count += num_tuples
+    self._cumulative.clear()
+    if label is not None and self._min <= 0:
+      self.labels.add(label)
+
+    if numpy is not None:
+      indexes = numpy.array(indexes, dtype=numpy.int64)
+      codes = numpy.zeros(num_tuples, dtype=numpy.int64)
+    else:
+      codes = [0] * num_tuples
+
+    for depth in xrange(1, self._max+1):
+      # windows starting past seq_len-depth are too short to reach this depth
+      num_windows = min(seq_len - depth + 1, num_tuples)
+      if num_windows <= 0:
+        break
+      window = indexes[depth-1:depth-1+num_windows]
+      if numpy is not None:
+        parent_codes = codes[:num_windows]
+        codes = parent_codes * self._size + window
+        found, found_counts = numpy.unique(codes, return_counts=True)
+        parents, inverse = numpy.unique(found // self._size,
+                                        return_inverse=True)
+        rows = numpy.array([self._Row(depth, parent)
+                            for parent in parents.tolist()],
+                           dtype=numpy.int64)
+        slots = rows[inverse] * self._size + found % self._size
+        self._counts[depth][slots] += found_counts.astype(numpy.uint32)
+        if label is not None and depth >= self._min:
+          self._AddLabel(depth, found.tolist(), label)
+      else:
+        codes = [code * self._size + ind
+                 for code, ind in zip(codes[:num_windows], window)]
+        counts = self._counts[depth]
+        for code in codes:
+          parent, ind = divmod(code, self._size)
+          counts[self._Row(depth, parent) * self._size + ind] += 1
+        if label is not None and depth >= self._min:
+          self._AddLabel(depth, set(codes), label)
+
+  def _AddLabel(self, depth, codes, label):
+    for code in codes:
+      key = (depth, code)
+      if key not in self._labels:
+        self._labels[key] = set()
+      self._labels[key].add(label)
+
+  def _NodeCount(self, depth, code):
+    if depth == 0:
+      return self.count
+    parent, ind = divmod(code, self._size)
+    row = self._rows[depth].get(parent)
+    if row is None:
+      return 0
+    return int(self._counts[depth][row * self._size + ind])
+
+  def _NodeLabels(self, depth, code):
+    if depth == 0:
+      return self.labels
+    return self._labels.get((depth, code), ())
+
+  def _Cumulative(self, depth, code):
+    """Returns the cumulative counts of the children of a node, or None if
+    it has none."""
+    key = (depth, code)
+    cumulative = self._cumulative.get(key)
+    if cumulative is None:
+      row = self._rows[depth+1].get(code)
+      if row is None:
+        return None
+      start = row * self._size
+      row = self._counts[depth+1][start:start+len(self._elements)]
+      if numpy is not None:
+        cumulative = numpy.cumsum(row, dtype=numpy.int64)
+      else:
+        cumulative = []
+        total = 0
+        for count in row:
+          total += count
+          cumulative.append(total)
+      self._cumulative[key] = cumulative
+    return cumulative
+
+  def _HasChildren(self, depth, code):
+    if depth >= self._max or not self._elements:
+      return False
+    cumulative = self._Cumulative(depth, code)
+    return cumulative is not None and cumulative[-1] > 0
+
+  def _GetRandomElement(self, depth, code, rng=random):
+    """Find the index of a random child of a node.
+
+    Arguments:
+      rng: source of random numbers, defaults to the random module.
+
+    Returns:
+      An index weighted by the distribution, or None if the end condition is
+      hit.
+    """
+    cumulative = self._Cumulative(depth, code)
+    target = rng.uniform(0, self._NodeCount(depth, code))
+    if numpy is not None:
+      ind = int(numpy.searchsorted(cumulative, target, side='right'))
+    else:
+      ind = bisect.bisect_right(cumulative, target)
+    if ind >= len(cumulative):
+      return None
+    return ind
+
+  def GetRandomTuple(self, seed=None, depth=None, labelset=None, rng=None):
+    """Get a random n-tuple based on the seed provided.
+
+    Arguments:
+      seed: (optional) a seed tuple
+      depth: (optional) integer value of the max depth into the tree of the tuple
+      labelset: If not None, assumed to be a set of lables involved in this
+        sequence, which will be updated.
+      rng: (optional) random number source or seed, see
+        random_streams.get_rng()
+
+    Returns:
+      a tuple based on the seed and the distribution in the chain
+
+    Raises:
+      ValueError: if depth > max for the whole chain
+    """
+    if depth is None:
+      depth = self._max
+    elif depth > self._max:
+      raise ValueError("depth cannot exceed the tree depth")
+    if seed is None:
+      seed = ()
+    rng = get_rng(rng)
+
+    node_depth, code = 0, 0
+    result = []
+    while node_depth < depth and self._HasChildren(node_depth, code):
+      if node_depth < len(seed):
+        ind = self._index.get(seed[node_depth])
+        if (ind is not None and
+            self._NodeCount(node_depth+1, code * self._size + ind) == 0):
+          ind = None
+      else:
+        ind = self._GetRandomElement(node_depth, code, rng)
+
+      if ind is None:
+        break
+      result.append(self._elements[ind])
+      node_depth += 1
+      code = code * self._size + ind
+
+    if labelset is not None:
+      labelset.update(self._NodeLabels(node_depth, code))
+    return tuple(result)
+
+  def GetRandomSequence(self, seed=None, depth=None, labelset=None, rng=None):
+    """Generate a random sequence of elements.
+
+    See tree.MarkovChain.GetRandomSequence() for details.
+
+    Returns:
+      An iterable sequence of elements.
+    """
+    if depth is not None:
+      full_seq_len = depth
+    else:
+      full_seq_len = self._max
+    rng = get_rng(rng)
+
+    if seed and len(seed) >= full_seq_len:
+      excess = len(seed) - full_seq_len
+      for ind in xrange(0,excess):
+        yield seed[ind]
+      seq = tuple(seed[excess:])
+    else:
+      seq = self.GetRandomTuple(seed, depth, labelset=labelset, rng=rng)
+
+    while len(seq) >= full_seq_len:
+      yield seq[0]
+      seq = seq[1:]
+      new_seq = self.GetRandomTuple(seq, depth=depth, labelset=labelset,
+                                    rng=rng)
+      if new_seq:
+        seq = new_seq
+
+    for element in seq:
+      yield element
+
+  def _GetLabels(self, seq):
+    code = 0
+    for depth, element in enumerate(seq):
+      ind = self._index.get(element)
+      if (depth >= self._max or ind is None
+          or self._NodeCount(depth+1, code * self._size + ind) == 0):
+        return None
+      code = code * self._size + ind
+    return set(self._NodeLabels(len(seq), code))
+
+  def GetAnnotatedSequence(self, seed=None, depth=None, rng=None):
+
+    if depth is None:
+      depth = self._max
+    rng = get_rng(rng)
+
+    while seed and len(seed) >= depth:
+      seq = seed[:depth]
+      labelset = self._GetLabels(seq)
+      yield seq[0], labelset
+      seed = seed[1:]
+
+    labelset = set()
+    seq = self.GetRandomTuple(seed, depth=depth, labelset=labelset, rng=rng)
+    while len(seq) >= depth:
+      yield seq[0], labelset
+      labelset = set()
+      seq = self.GetRandomTuple(seq[1:], depth=depth, labelset=labelset,
+                                rng=rng)
+
+    for element in seq:
+      yield element, labelset
@@ -0,0 +1,89 @@
+#!/usr/bin/python
+
+import random
+import unittest
+
+import dense
+from dense import MarkovChain
+import tree
+
+class DenseMarkovTest(unittest.TestCase):
+  def testMarkovChainInit(self):
+    mc = MarkovChain(max=3)
+    self.assertEqual(0, mc.count, "Nonzero count in fresh instance")
+    self.assertEqual(tuple(), mc.GetRandomTuple(),
+                    "Empty chain should return an empty tuple.")
+    self.assertEqual(3, mc._max, "max tuple length not set properly")
+    self.assertEqual(2, mc._min, "Min value should have a default of max-1")
+    self.assertEqual(set(), mc.labels, "Labelset is not a null set")
+
+  def testAlphabetOverflow(self):
+    mc = MarkovChain(max=2, alphabet_size=2)
+    mc.Update('abab')
+    self.assertRaises(ValueError, mc.Update, 'abc')
+
+  def testChainUpdate(self):
+    mc = MarkovChain(max=3)
+    mc.Update('abc', label='first')
+    retSeq = mc.GetRandomTuple(('a',))
+    self.assertEqual(('a','b','c',), retSeq, "Initial Tuple not recovered with"
+                     " appropriate seed: got %s" % repr(retSeq))
+    fullSeq = ''.join(mc.GetRandomSequence(('a',)))
+    self.assertEqual('abc', fullSeq, "Didn't full full sequence"
+                     " back out, only %s" % fullSeq)
+    used_labels = set()
+    mc.GetRandomTuple(('b',), labelset=used_labels)
+    self.assertEqual(set(['first']), used_labels,
+                     "Set of used labels wasn't correct, got %s"
+                      % (used_labels,))
+    self.assertEqual([('a', set(['first'])), ('b', set(['first'])),
+                      ('c', set(['first']))],
+                     list(mc.GetAnnotatedSequence('ab')))
+
+  def _CheckCountsMatchTree(self):
+    rnd = random.Random(1234)
+    text = ''.join(rnd.choice('abcd ') for _ in xrange(500))
+    dmc = MarkovChain(max=4, min=2, alphabet_size=8)
+    tmc = tree.MarkovChain(max=4, min=2)
+    for para in (text[:200], text[200:], 'ab'):
+      dmc.Update(para)
+      tmc.Update(para)
+
+    self.assertEqual(tmc.count, dmc.count)
+    stack = [(tmc, 0, 0)]
+    while stack:
+      node, depth, code = stack.pop()
+      if depth == tmc._max:
+        continue
+      for element, child in node.items():
+        child_code = code * dmc._size + dmc._index[element]
+        self.assertEqual(child.count, dmc._NodeCount(depth+1, child_code))
+        stack.append((child, depth+1, child_code))
+    self.assertEqual(tmc.count, sum(dmc._counts[1]))
+    generated = ''.join(dmc.GetRandomSequence('abc', rng=1))
+    self.assertEqual('abc', generated[:3])
+    self.assertEqual(set(), set(generated) - set('abcd '))
+
+  def testCountsMatchTree(self):
+    self._CheckCountsMatchTree()
+
+  def testCountsMatchTreeWithoutNumpy(self):
+    saved, dense.numpy = dense.numpy, None
+    try:
+      self._CheckCountsMatchTree()
+    finally:
+      dense.numpy = saved
+
+  def testRowsAllocatedLazily(self):
+    mc = MarkovChain(max=5)
+    self.assertEqual([0] * 5, [len(counts) for counts in mc._counts[1:]])
+    mc.Update('the cat sat on the mat')
+    # one row per distinct context with a child
+    self.assertEqual(len(set(['the cat sat on the mat'[i:i+3]
+                              for i in xrange(19)])),
+                     len(mc._rows[4]))
+    self.assertEqual(('t', 'h', 'e', ' ', 'c'), mc.GetRandomTuple('the c'))
+    self.assertRaises(ValueError, MarkovChain, max=8, alphabet_size=256)
+
+if __name__ == "__main__":
+  unittest.main()
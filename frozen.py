@@ -0,0 +1,477 @@
+#!/usr/bin/python
+
+"""A read-only tree.MarkovChain in one flat file, for pre-forked workers.
+
+Forked workers share a tree.MarkovChain's memory only until they touch it,
+and every lookup, and every garbage collection, writes to the reference
+counts and headers of the dicts and sets it visits, so each worker soon has
+a private copy of the model.  Freeze() writes the tree out once as arrays
+of fixed size records, and FrozenChain samples straight from a read-only
+mmap of that file, without making a Python object per node.  The pages
+belong to the page cache, so every process that maps the file shares them,
+however many workers there are.
+
+  frozen.Freeze(chain, 'model.frozen')
+  pool = frozen.GeneratorPool('model.frozen', workers=8)
+  for sequence in pool.Generate(seeds, rng_seed=1):
+    ...
+
+The nodes are stored breadth first, so each node's children are adjacent,
+sorted by element so that a seed can be found by binary search.  Each child
+record also holds the running total of its siblings' counts, so sampling is
+a binary search too.  The distribution is the same as the tree's, but the
+same rng gives different sequences, as the tree scans its children in dict
+order.
+
+Elements and labels must be strings.
+"""
+
+from array import array
+import gc
+import mmap
+import multiprocessing
+import os
+import random
+import struct
+import sys
+
+from random_streams import get_rng
+from random_streams import stream
+import tree
+
+MAGIC = 'MKVFRZ01'
+# magic, max, min, then the node, element, label and label reference counts,
+# then the offsets of the nodes, label references, element offsets, element
+# data, label offsets and label data
+_HEADER = struct.Struct('<8sII4Q6Q')
+# count, running total of the counts of the node and its earlier siblings,
+# element id, first child, number of children, first label, number of labels
+_NODE = struct.Struct('<QQIIIII')
+_COUNT, _CUMULATIVE, _ELEMENT, _FIRST_CHILD, _CHILDREN, _FIRST_LABEL, _LABELS = (
+    range(7))
+_OFFSET = struct.Struct('<Q')
+_ID = struct.Struct('<I')
+
+
+def _Key(string):
+  """Returns the bytes a string is stored and sorted as."""
+  if isinstance(string, unicode):
+    try:
+      # so that u'a' finds 'a', as it would in a dict
+      return '\x00' + string.encode('ascii')
+    except UnicodeEncodeError:
+      return '\x01' + string.encode('utf-8')
+  if isinstance(string, str):
+    return '\x00' + string
+  raise TypeError('Only strings can be frozen, not {!r}'.format(string))
+
+
+def _FromKey(key):
+  if key[0] == '\x01':
+    return key[1:].decode('utf-8')
+  return key[1:]
+
+
+def _Align(fh):
+  padding = -fh.tell() % 8
+  fh.write('\x00' * padding)
+  return fh.tell()
+
+
+def _WriteStrings(fh, keys):
+  """Writes an offset table and the sorted keys, and returns both offsets."""
+  offsets_offset = _Align(fh)
+  position = 0
+  fh.write(_OFFSET.pack(position))
+  for key in keys:
+    position += len(key)
+    fh.write(_OFFSET.pack(position))
+  data_offset = fh.tell()
+  for key in keys:
+    fh.write(key)
+  return offsets_offset, data_offset
+
+
+def Freeze(chain, path):
+  """Writes chain, a tree.MarkovChain, to path in the frozen format.
+
+  The file is written under a temporary name and renamed into place, so a
+  FrozenChain never sees a partly written file.
+  """
+  elements = set()
+  labels = set()
+  stack = [chain]
+  while stack:
+    node = stack.pop()
+    labels.update(node.labels)
+    if isinstance(node, tree.MarkovChain):
+      elements.update(node.iterkeys())
+      stack.extend(node.itervalues())
+  element_keys = sorted(_Key(element) for element in elements)
+  element_ids = dict((_FromKey(key), index)
+                     for index, key in enumerate(element_keys))
+  label_keys = sorted(_Key(label) for label in labels)
+  label_ids = dict((_FromKey(key), index)
+                   for index, key in enumerate(label_keys))
+  del elements, labels
+
+  tmp_path = path + '.tmp'
+  with open(tmp_path, 'wb') as fh:
+    fh.write('\x00' * _HEADER.size)
+    nodes_offset = _Align(fh)
+    nodes = [chain]
+    element_of = array('I', [0])
+    cumulative_of = array('L', [chain.count])
+    label_refs = array('I')
+    index = 0
+    while index < len(nodes):
+      node = nodes[index]
+      # drop it once written, so the walk doesn't hold the whole tree twice
+      nodes[index] = None
+      first_child = len(nodes)
+      if isinstance(node, tree.MarkovChain):
+        children = sorted((element_ids[element], child)
+                          for element, child in node.iteritems())
+        cumulative = 0
+        for element_id, child in children:
+          cumulative += child.count
+          nodes.append(child)
+          element_of.append(element_id)
+          cumulative_of.append(cumulative)
+      first_label = len(label_refs)
+      label_refs.extend(sorted(label_ids[label] for label in node.labels))
+      fh.write(_NODE.pack(node.count, cumulative_of[index],
+                          element_of[index], first_child,
+                          len(nodes) - first_child, first_label,
+                          len(label_refs) - first_label))
+      index += 1
+
+    label_refs_offset = _Align(fh)
+    label_refs.tofile(fh)
+    element_offsets, element_data = _WriteStrings(fh, element_keys)
+    label_offsets, label_data = _WriteStrings(fh, label_keys)
+
+    fh.seek(0)
+    fh.write(_HEADER.pack(MAGIC, chain._max, chain._min, len(nodes),
+                          len(element_keys), len(label_keys), len(label_refs),
+                          nodes_offset, label_refs_offset, element_offsets,
+                          element_data, label_offsets, label_data))
+  os.rename(tmp_path, path)
+
+
+class FrozenChain(object):
+  """Generates from a file written by Freeze(), like a tree.MarkovChain."""
+
+  def __init__(self, path):
+    with open(path, 'rb') as fh:
+      self._map = mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ)
+    header = _HEADER.unpack_from(self._map)
+    if header[0] != MAGIC:
+      raise ValueError('{} is not a frozen chain'.format(path))
+    (self._max, self._min, self._node_count, self._element_count,
+     self._label_count, _, self._nodes, self._label_refs,
+     self._element_offsets, self._element_data, self._label_offsets,
+     self._label_data) = header[1:]
+    self.count = self._Node(0)[_COUNT]
+
+  def Close(self):
+    self._map.close()
+
+  def _Node(self, index):
+    return _NODE.unpack_from(self._map, self._nodes + index * _NODE.size)
+
+  def _String(self, offsets, data, index):
+    start, end = struct.unpack_from('<QQ', self._map,
+                                    offsets + index * _OFFSET.size)
+    return self._map[data+start:data+end]
+
+  def _Element(self, node):
+    return _FromKey(self._String(self._element_offsets, self._element_data,
+                                 node[_ELEMENT]))
+
+  def _FindElement(self, element):
+    """Returns the id of element, or None if it isn't in the chain."""
+    try:
+      key = _Key(element)
+    except TypeError:
+      return None
+    lo, hi = 0, self._element_count
+    while lo < hi:
+      mid = (lo + hi) // 2
+      if self._String(self._element_offsets, self._element_data, mid) < key:
+        lo = mid + 1
+      else:
+        hi = mid
+    if (lo < self._element_count and
+        self._String(self._element_offsets, self._element_data, lo) == key):
+      return lo
+    return None
+
+  def _FindChild(self, node, element):
+    element_id = self._FindElement(element)
+    if element_id is None:
+      return None
+    lo = node[_FIRST_CHILD]
+    hi = lo + node[_CHILDREN]
+    while lo < hi:
+      mid = (lo + hi) // 2
+      child = self._Node(mid)
+      if child[_ELEMENT] < element_id:
+        lo = mid + 1
+      elif child[_ELEMENT] > element_id:
+        hi = mid
+      else:
+        return child
+    return None
+
+  def _SampleChild(self, node, rng):
+    """Picks a child weighted by count, or None for the end condition."""
+    target = rng.uniform(0, node[_COUNT])
+    lo = node[_FIRST_CHILD]
+    hi = lo + node[_CHILDREN]
+    while lo < hi:
+      mid = (lo + hi) // 2
+      if self._Node(mid)[_CUMULATIVE] <= target:
+        lo = mid + 1
+      else:
+        hi = mid
+    if lo == node[_FIRST_CHILD] + node[_CHILDREN]:
+      return None
+    return self._Node(lo)
+
+  def _AddLabels(self, node, labelset):
+    if labelset is None:
+      return
+    for ref in xrange(node[_FIRST_LABEL], node[_FIRST_LABEL] + node[_LABELS]):
+      label_id = _ID.unpack_from(self._map,
+                                 self._label_refs + ref * _ID.size)[0]
+      labelset.add(_FromKey(self._String(self._label_offsets,
+                                         self._label_data, label_id)))
+
+  def GetRandomTuple(self, seed=None, depth=None, labelset=None, rng=None):
+    """Get a random n-tuple based on the seed, see tree.MarkovChain."""
+    if depth is None:
+      depth = self._max
+    elif depth > self._max:
+      raise ValueError("depth cannot exceed the tree depth")
+
+    node = self._Node(0)
+    result = []
+    while True:
+      if depth == 0 or node[_CHILDREN] == 0:
+        self._AddLabels(node, labelset)
+        return tuple(result)
+
+      if seed:
+        element = seed[0]
+        seed = seed[1:]
+        child = self._FindChild(node, element) if element else None
+      else:
+        rng = get_rng(rng)
+        child = self._SampleChild(node, rng)
+        element = self._Element(child) if child is not None else None
+      if child is None:
+        self._AddLabels(node, labelset)
+        return tuple(result)
+
+      result.append(element)
+      if depth <= 1:
+        self._AddLabels(child, labelset)
+        return tuple(result)
+      node = child
+      depth -= 1
+
+  def GetRandomSequence(self, seed=None, depth=None, labelset=None, rng=None):
+    """Generate a random sequence of elements, see tree.MarkovChain."""
+    if depth is not None:
+      full_seq_len = depth
+    else:
+      full_seq_len = self._max
+    rng = get_rng(rng)
+
+    if seed and len(seed) >= full_seq_len:
+      excess = len(seed) - full_seq_len
+      for ind in xrange(0, excess):
+        yield seed[ind]
+      seq = seed[excess:]
+    else:
+      seq = self.GetRandomTuple(seed, depth, labelset=labelset, rng=rng)
+
+    while len(seq) >= full_seq_len:
+      yield seq[0]
+      seq = seq[1:]
+      new_seq = self.GetRandomTuple(seq, depth=depth, labelset=labelset,
+                                    rng=rng)
+      if new_seq:
+        seq = new_seq
+
+    for element in seq:
+      yield element
+
+  def _GetLabels(self, seq):
+    node = self._Node(0)
+    for element in seq:
+      node = self._FindChild(node, element)
+      if node is None:
+        return None
+    labelset = set()
+    self._AddLabels(node, labelset)
+    return labelset
+
+  def GetAnnotatedSequence(self, seed=None, depth=None, rng=None):
+    """Generate (element, labels) pairs, see tree.MarkovChain."""
+    if depth is None:
+      depth = self._max
+    rng = get_rng(rng)
+
+    while seed and len(seed) >= depth:
+      seq = seed[:depth]
+      yield seq[0], self._GetLabels(seq)
+      seed = seed[1:]
+
+    labelset = set()
+    seq = self.GetRandomTuple(seed, depth=depth, labelset=labelset, rng=rng)
+    while len(seq) >= depth:
+      yield seq[0], labelset
+      labelset = set()
+      seq = self.GetRandomTuple(seq[1:], depth=depth, labelset=labelset,
+                                rng=rng)
+
+    for element in seq:
+      yield element, labelset
+
+
+# The chain used by pool workers, opened when each one starts.
+_worker_chain = None
+
+def _OpenWorker(path):
+  global _worker_chain
+  _worker_chain = FrozenChain(path)
+  # forked workers would otherwise all share the parent's random state
+  random.seed()
+
+def _GenerateOne(args):
+  index, seed, rng_seed, max_tokens = args
+  rng = None if rng_seed is None else stream(rng_seed, index)
+  sequence = []
+  for element in _worker_chain.GetRandomSequence(seed, rng=rng):
+    if max_tokens is not None and len(sequence) >= max_tokens:
+      break
+    sequence.append(element)
+  return sequence
+
+
+class GeneratorPool(object):
+  """A pool of forked processes generating from one frozen chain."""
+
+  def __init__(self, path, workers=4):
+    self._pool = multiprocessing.Pool(workers, initializer=_OpenWorker,
+                                      initargs=(path,))
+
+  def Generate(self, seeds, rng_seed=None, max_tokens=None, chunksize=64):
+    """Yields a generated sequence, as a list, for each seed in seeds.
+
+    With an rng_seed, each sequence gets its own random stream, so the
+    results are the same for any number of workers.
+    """
+    jobs = ((index, seed, rng_seed, max_tokens)
+            for index, seed in enumerate(seeds))
+    return self._pool.imap(_GenerateOne, jobs, chunksize=chunksize)
+
+  def Close(self):
+    self._pool.close()
+    self._pool.join()
+
+
+def _Memory():
+  """Returns this process's (PSS, private) memory in bytes."""
+  memory = {}
+  with open('/proc/self/smaps_rollup') as fh:
+    for line in fh:
+      fields = line.split()
+      if len(fields) == 3 and fields[2] == 'kB':
+        memory[fields[0].rstrip(':')] = int(fields[1]) * 1024
+  return (memory['Pss'],
+          memory['Private_Clean'] + memory['Private_Dirty'])
+
+
+def _MeasureWorker(chain, path, seeds, results, done):
+  if chain is None:
+    chain = FrozenChain(path)
+  rng = random.Random(os.getpid())
+  for seed in seeds:
+    for _ in chain.GetRandomSequence(seed, rng=rng):
+      pass
+  # a long running worker collects garbage sooner or later
+  gc.collect()
+  results.put(_Memory())
+  # stay alive until every worker has measured, so the pages stay shared
+  done.wait()
+
+
+def _MeasureWorkers(chain, path, seeds, workers):
+  results = multiprocessing.Queue()
+  done = multiprocessing.Event()
+  children = [multiprocessing.Process(
+      target=_MeasureWorker, args=(chain, path, seeds, results, done))
+              for _ in xrange(workers)]
+  for child in children:
+    child.start()
+  memory = [results.get() for _ in children]
+  done.set()
+  for child in children:
+    child.join()
+  return memory
+
+
+def _Train(words, max):
+  from bench import corpus
+  chain = tree.MarkovChain(max=max)
+  for seq in corpus.zipf_corpus(num_words=words):
+    chain.Update(seq)
+  return chain
+
+
+def _InChild(target, *args):
+  """Runs target in a child process, and returns its result."""
+  results = multiprocessing.Queue()
+  child = multiprocessing.Process(
+      target=lambda: results.put(target(*args)))
+  child.start()
+  result = results.get()
+  child.join()
+  return result
+
+
+if __name__ == '__main__':
+  # Measures the memory of pools of workers generating from a live tree and
+  # from its frozen copy:
+  #   frozen.py [words] [max]
+  # The trees are only ever built in child processes, so that the frozen
+  # workers are forked from a process that never held one.
+  import tempfile
+  from bench import corpus
+
+  words = int(sys.argv[1]) if len(sys.argv) > 1 else 500000
+  max = int(sys.argv[2]) if len(sys.argv) > 2 else 3
+  seeds = [tuple(seq[:max-1]) for seq in corpus.zipf_corpus(num_words=words)[:500]]
+  path = os.path.join(tempfile.mkdtemp(prefix='markov-frozen-'), 'chain')
+  _InChild(lambda: Freeze(_Train(words, max), path))
+  print('{} words, {:.1f} MB frozen'.format(words,
+                                            os.path.getsize(path) / 1e6))
+  print('{:8} {:>8} {:>16} {:>22}'.format('model', 'workers', 'total PSS MB',
+                                          'private MB per worker'))
+  try:
+    for workers in (1, 2, 4, 8):
+      for name in ('tree', 'frozen'):
+        if name == 'tree':
+          memory = _InChild(lambda: _MeasureWorkers(_Train(words, max), None,
+                                                    seeds, workers))
+        else:
+          memory = _MeasureWorkers(None, path, seeds, workers)
+        print('{:8} {:>8} {:>16.1f} {:>22.1f}'.format(
+            name, workers, sum(pss for pss, _ in memory) / 1e6,
+            sum(private for _, private in memory) / 1e6 / workers))
+  finally:
+    os.unlink(path)
+    os.rmdir(os.path.dirname(path))
@@ -0,0 +1,76 @@
+#!/usr/bin/python
+
+import os
+import random
+import shutil
+import tempfile
+import unittest
+
+import frozen
+import tree
+
+class FrozenChainTest(unittest.TestCase):
+  def setUp(self):
+    self.tmpdir = tempfile.mkdtemp()
+    self.path = os.path.join(self.tmpdir, 'chain')
+    self.chain = tree.MarkovChain(max=3)
+    self.chain.Update('the cat sat on the mat'.split(), label='cat')
+    self.chain.Update('the dog sat on the log'.split(), label=u'd\xf6g')
+    frozen.Freeze(self.chain, self.path)
+    self.frozen = frozen.FrozenChain(self.path)
+
+  def tearDown(self):
+    self.frozen.Close()
+    shutil.rmtree(self.tmpdir)
+
+  def testSeeded(self):
+    self.assertEqual(self.chain.count, self.frozen.count)
+    self.assertEqual(('the', 'cat', 'sat'),
+                     self.frozen.GetRandomTuple(('the', 'cat')))
+    self.assertEqual(('the',), self.frozen.GetRandomTuple(('the', 'cow')),
+                     "Unseen seed should stop where it leaves the chain")
+    self.assertEqual(('the',), self.frozen.GetRandomTuple((u'the', 42)))
+    self.assertEqual('the cat sat on the',
+                     ' '.join(self.frozen.GetRandomSequence(('the', 'cat'),
+                                                           rng=1))[:18])
+    self.assertEqual([('the', set(['cat'])), ('cat', set(['cat']))],
+                     list(self.frozen.GetAnnotatedSequence(
+                         ('the', 'cat', 'sat')))[:2])
+    labels = set()
+    self.frozen.GetRandomTuple(('the', 'dog', 'sat'), labelset=labels)
+    self.assertEqual(set([u'd\xf6g']), labels)
+
+  def testDistribution(self):
+    rng = random.Random(3)
+    counts = {}
+    for _ in xrange(2000):
+      t = self.frozen.GetRandomTuple(('sat', 'on'), rng=rng)
+      counts[t] = counts.get(t, 0) + 1
+    self.assertEqual([('sat', 'on', 'the')], counts.keys())
+    firsts = {}
+    for _ in xrange(4000):
+      first = self.frozen.GetRandomTuple(rng=rng)[0]
+      firsts[first] = firsts.get(first, 0) + 1
+    # 'the' starts 4 of the 10 tuples counted at the root
+    self.assertTrue(1450 < firsts['the'] < 1750, firsts)
+
+  def testPool(self):
+    pool = frozen.GeneratorPool(self.path, workers=2)
+    try:
+      seeds = [('the', 'cat'), ('the', 'dog')] * 10
+      first = list(pool.Generate(seeds, rng_seed=5, max_tokens=4))
+      second = list(pool.Generate(seeds, rng_seed=5, max_tokens=4))
+    finally:
+      pool.Close()
+    self.assertEqual(first, second,
+                     "The same rng_seed should give the same sequences")
+    self.assertEqual(['the', 'cat', 'sat', 'on'], first[0])
+    self.assertEqual(['the', 'dog', 'sat', 'on'], first[1])
+
+  def testNotFrozen(self):
+    with open(self.path, 'wb') as fh:
+      fh.write('\x00' * 256)
+    self.assertRaises(ValueError, frozen.FrozenChain, self.path)
+
+if __name__ == "__main__":
+  unittest.main()
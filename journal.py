@@ -0,0 +1,258 @@
+#!/usr/bin/python
+
+"""Durable incremental persistence for tree.MarkovChain.
+
+A JournaledChain keeps a tree.MarkovChain in memory, and appends every
+update to a log before applying it.  When the log grows past compact_bytes,
+a forked child writes the whole chain out as a new snapshot while the
+parent carries on with a fresh log, and the logs the snapshot covers are
+deleted once it's safely in place.  On startup the snapshot is loaded, and
+the logs written since are replayed on top of it, so recovery never has to
+replay more than about compact_bytes of log.
+
+  chain = journal.JournaledChain('/var/lib/markov/chain', max=3)
+  chain.Update(words, label='doc1')
+  chain.Sync()
+  for word in chain.GetRandomSequence(): ...
+
+The files are:
+  path: the snapshot, a pickled (generation, chain) pair, where every log
+    before generation has been applied to chain.
+  path.log.<generation>: the logs, in order.  Each record is a length, a
+    CRC-32 and a marshalled list of (sequence, label) pairs.  A record that
+    was only partly written, as after a crash, ends the replay of its log.
+
+Elements and labels must be types marshal can write, such as strings and
+numbers.
+"""
+
+import cPickle
+import logging
+import marshal
+import os
+import struct
+import zlib
+
+import tree
+
+# length and CRC-32 of each record's payload
+_RECORD = struct.Struct('<II')
+
+# The log size that triggers a compaction.
+COMPACT_BYTES = 64 << 20
+
+
+def _ReadRecords(filename):
+  """Yields the list of updates in each intact record of a log."""
+  with open(filename, 'rb') as fh:
+    while True:
+      header = fh.read(_RECORD.size)
+      if not header:
+        return
+      if len(header) < _RECORD.size:
+        break
+      length, crc = _RECORD.unpack(header)
+      payload = fh.read(length)
+      if len(payload) < length or zlib.crc32(payload) & 0xffffffff != crc:
+        break
+      try:
+        yield marshal.loads(payload)
+      except (EOFError, ValueError, TypeError):
+        break
+    logging.warning('Ignoring torn record at offset %d of %s',
+                    fh.tell(), filename)
+
+
+class JournaledChain(object):
+  """A tree.MarkovChain whose updates are logged to disk.
+
+  Anything other than updating is passed through to the chain, so this can
+  be used for generation in place of a tree.MarkovChain.
+  """
+
+  def __init__(self, path, max=3, min=None, compact_bytes=COMPACT_BYTES,
+               fsync=False, background=True):
+    """Opens the chain at path, creating it if it doesn't exist.
+
+    Arguments:
+      path: the snapshot file; the logs are kept next to it.
+      max, min: for a new chain, see tree.MarkovChain.  max must match an
+        existing snapshot.
+      compact_bytes: log size at which to compact, or None for only when
+        Compact() is called.
+      fsync: whether to fsync the log after every update, rather than only
+        when Sync() is called.
+      background: whether to write snapshots in a forked child process,
+        rather than blocking until they're written.
+    """
+    self.path = path
+    self.compact_bytes = compact_bytes
+    self.fsync = fsync
+    self.background = background
+    self._compacting = None
+
+    generation = 0
+    if os.path.exists(path):
+      with open(path, 'rb') as fh:
+        generation, self.chain = cPickle.load(fh)
+      if self.chain._max != max:
+        raise ValueError('max for {} already set to {}, not {}'.format(
+            path, self.chain._max, max))
+    else:
+      self.chain = tree.MarkovChain(max=max, min=min)
+
+    logs = self._Logs()
+    if not logs and not os.path.exists(path):
+      # so that max and min are kept from the start
+      self._WriteSnapshot(generation)
+    for log_generation, filename in logs:
+      if log_generation >= generation:
+        self._Replay(filename)
+    if logs and logs[-1][0] >= generation:
+      generation = logs[-1][0] + 1
+    # a fresh log, rather than appending after what may be a torn record
+    self._OpenLog(generation)
+
+  def __getattr__(self, name):
+    if name == 'chain':
+      # not loaded yet
+      raise AttributeError(name)
+    return getattr(self.chain, name)
+
+  def _Logs(self):
+    """Returns (generation, filename) for each log, oldest first."""
+    directory, base = os.path.split(self.path)
+    prefix = base + '.log.'
+    logs = []
+    for filename in os.listdir(directory or '.'):
+      suffix = filename[len(prefix):]
+      if filename.startswith(prefix) and suffix.isdigit():
+        logs.append((int(suffix), os.path.join(directory, filename)))
+    return sorted(logs)
+
+  def _Replay(self, filename):
+    for updates in _ReadRecords(filename):
+      for seq, label in updates:
+        self.chain.Update(seq, label=label)
+
+  def _OpenLog(self, generation):
+    self._generation = generation
+    self._log = open('{}.log.{}'.format(self.path, generation), 'ab')
+
+  def Update(self, seq, label=None):
+    """Logs and applies an update, like tree.MarkovChain.Update()."""
+    self.UpdateMany([(seq, label)])
+
+  def UpdateMany(self, updates):
+    """Logs a batch of (sequence, label) updates as one record, and applies
+    them.
+
+    Raises:
+      TypeError: an element or label isn't hashable.
+      ValueError: an element or label can't be marshalled.
+    """
+    updates = [(list(seq), label) for seq, label in updates]
+    # checked before logging, as a record the chain rejects would make every
+    # later replay fail too
+    for seq, label in updates:
+      for value in seq + [label]:
+        hash(value)
+    payload = marshal.dumps(updates)
+    self._log.write(_RECORD.pack(len(payload), zlib.crc32(payload) & 0xffffffff))
+    self._log.write(payload)
+    if self.fsync:
+      self.Sync()
+    for seq, label in updates:
+      self.chain.Update(seq, label=label)
+
+    self._PollCompaction()
+    if (self.compact_bytes is not None and self._compacting is None and
+        self._log.tell() >= self.compact_bytes):
+      self.Compact()
+
+  def Sync(self):
+    """Makes every update so far durable."""
+    self._log.flush()
+    os.fsync(self._log.fileno())
+
+  def Compact(self, wait=False):
+    """Writes a new snapshot and drops the logs it covers.
+
+    The log is rotated first, so updates carry on into the new log while a
+    background snapshot is written.  Does nothing if a background compaction
+    is already running.
+
+    Arguments:
+      wait: whether to wait for a background compaction to finish.
+    """
+    self._PollCompaction()
+    if self._compacting is not None:
+      if wait:
+        self.WaitForCompaction()
+      return
+
+    self.Sync()
+    self._log.close()
+    generation = self._generation + 1
+    self._OpenLog(generation)
+
+    if not self.background:
+      self._WriteSnapshot(generation)
+      self._DropLogs(generation)
+      return
+
+    pid = os.fork()
+    if pid == 0:
+      # the child has a consistent copy of the chain, thanks to fork
+      status = 1
+      try:
+        self._WriteSnapshot(generation)
+        status = 0
+      except Exception:
+        logging.exception('Writing snapshot %s failed', self.path)
+      finally:
+        os._exit(status)
+    self._compacting = (pid, generation)
+    if wait:
+      self.WaitForCompaction()
+
+  def _WriteSnapshot(self, generation):
+    tmp_path = self.path + '.tmp'
+    with open(tmp_path, 'wb') as fh:
+      cPickle.dump((generation, self.chain), fh, cPickle.HIGHEST_PROTOCOL)
+      fh.flush()
+      os.fsync(fh.fileno())
+    os.rename(tmp_path, self.path)
+
+  def _DropLogs(self, generation):
+    for log_generation, filename in self._Logs():
+      if log_generation < generation:
+        os.unlink(filename)
+
+  def _Finished(self, status):
+    pid, generation = self._compacting
+    self._compacting = None
+    if os.WIFEXITED(status) and os.WEXITSTATUS(status) == 0:
+      self._DropLogs(generation)
+    else:
+      logging.error('Compaction of %s failed with status %d, keeping logs',
+                    self.path, status)
+
+  def _PollCompaction(self):
+    if self._compacting is None:
+      return
+    pid, status = os.waitpid(self._compacting[0], os.WNOHANG)
+    if pid:
+      self._Finished(status)
+
+  def WaitForCompaction(self):
+    """Waits for a background compaction, if there is one, to finish."""
+    if self._compacting is not None:
+      _, status = os.waitpid(self._compacting[0], 0)
+      self._Finished(status)
+
+  def Close(self):
+    """Waits for any compaction, and makes every update durable."""
+    self.WaitForCompaction()
+    self.Sync()
+    self._log.close()
@@ -0,0 +1,111 @@
+#!/usr/bin/python
+
+import os
+import shutil
+import tempfile
+import unittest
+
+import journal
+import tree
+
+PARAS = [('the cat sat on the mat'.split(), 'cat'),
+         ('the dog sat on the log'.split(), 'dog'),
+         ('a cat and a dog'.split(), None)]
+
+def _Nodes(chain):
+  """Returns {path: (count, labels)} for every node below chain."""
+  nodes = {}
+  stack = [(chain, ())]
+  while stack:
+    node, path = stack.pop()
+    nodes[path] = (node.count, set(node.labels))
+    if isinstance(node, tree.MarkovChain):
+      for element, child in node.items():
+        stack.append((child, path + (element,)))
+  return nodes
+
+class JournaledChainTest(unittest.TestCase):
+  def setUp(self):
+    self.tmpdir = tempfile.mkdtemp()
+    self.path = os.path.join(self.tmpdir, 'chain')
+    self.expected = tree.MarkovChain(max=3)
+    for seq, label in PARAS:
+      self.expected.Update(seq, label=label)
+
+  def tearDown(self):
+    shutil.rmtree(self.tmpdir)
+
+  def _Logs(self):
+    return sorted(name for name in os.listdir(self.tmpdir) if '.log.' in name)
+
+  def testReplay(self):
+    chain = journal.JournaledChain(self.path, max=3, compact_bytes=None)
+    chain.Update(PARAS[0][0], label=PARAS[0][1])
+    chain.UpdateMany(PARAS[1:])
+    chain.Sync()
+    self.assertEqual(self.expected.count, chain.count)
+    self.assertEqual(('the', 'cat', 'sat'), chain.GetRandomTuple(('the', 'cat')))
+
+    # without closing, as if the process had died
+    recovered = journal.JournaledChain(self.path, max=3)
+    self.assertEqual(_Nodes(self.expected), _Nodes(recovered.chain))
+    self.assertEqual(['chain.log.0', 'chain.log.1'], self._Logs())
+    recovered.Close()
+    chain.Close()
+    self.assertRaises(ValueError, journal.JournaledChain, self.path, max=4)
+
+  def testTornRecord(self):
+    chain = journal.JournaledChain(self.path, max=3)
+    chain.UpdateMany(PARAS)
+    chain.Close()
+    with open(self.path + '.log.0', 'ab') as fh:
+      fh.write('\x40\x00\x00\x00\x00\x00')
+
+    recovered = journal.JournaledChain(self.path, max=3)
+    self.assertEqual(_Nodes(self.expected), _Nodes(recovered.chain))
+    recovered.Update('the end'.split())
+    recovered.Close()
+    self.expected.Update('the end'.split())
+    self.assertEqual(_Nodes(self.expected),
+                     _Nodes(journal.JournaledChain(self.path, max=3).chain))
+
+  def testCompaction(self):
+    for background in (True, False):
+      chain = journal.JournaledChain(self.path, max=3, compact_bytes=100,
+                                     background=background)
+      for seq, label in PARAS:
+        chain.Update(seq, label=label)
+      chain.WaitForCompaction()
+      self.assertTrue(os.path.exists(self.path))
+      # every log before the current one is covered by the snapshot
+      self.assertEqual(['chain.log.%d' % chain._generation], self._Logs())
+      chain.Close()
+
+      recovered = journal.JournaledChain(self.path, max=3)
+      self.assertEqual(_Nodes(self.expected), _Nodes(recovered.chain))
+      recovered.Close()
+      shutil.rmtree(self.tmpdir)
+      os.mkdir(self.tmpdir)
+
+  def testUpdatesDuringCompaction(self):
+    chain = journal.JournaledChain(self.path, max=3, compact_bytes=None)
+    chain.Update(PARAS[0][0], label=PARAS[0][1])
+    chain.Compact()
+    chain.UpdateMany(PARAS[1:])
+    chain.Close()
+    recovered = journal.JournaledChain(self.path, max=3)
+    self.assertEqual(_Nodes(self.expected), _Nodes(recovered.chain))
+    recovered.Close()
+
+  def testRejectedUpdate(self):
+    chain = journal.JournaledChain(self.path, max=3)
+    chain.UpdateMany(PARAS)
+    self.assertRaises(TypeError, chain.Update, ['a', ['x'], 'c'])
+    self.assertRaises(ValueError, chain.Update, ['a', object(), 'c'])
+    chain.Close()
+    recovered = journal.JournaledChain(self.path, max=3)
+    self.assertEqual(_Nodes(self.expected), _Nodes(recovered.chain))
+    recovered.Close()
+
+if __name__ == "__main__":
+  unittest.main()
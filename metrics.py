@@ -0,0 +1,157 @@
+#!/usr/bin/python
+
+"""Opt-in counters and histograms for the hot paths of the chains.
+
+Instrumented code keeps a reference to a Metrics object, which is None
+unless metrics were asked for.  Methods marked with timed() are only wrapped
+in a timer by instrument() while there is a Metrics, and the rest of the
+hooks are outside the inner loops, so the cost when disabled is at most an
+attribute check per call.  MarkovPrefixSql takes a Metrics with its metrics
+argument or setMetrics(); tree.MarkovChain uses a module wide one set by
+tree.SetMetrics().
+
+  m = metrics.Metrics()
+  chain = prefix_sql.MarkovPrefixSql(max=3, metrics=m)
+  ...
+  print(m.Snapshot())
+"""
+
+import functools
+import threading
+import timeit
+
+_timer = timeit.default_timer
+
+
+class Histogram(object):
+  """Counts values in power of two buckets."""
+
+  __slots__ = ['count', 'total', 'min', 'max', 'buckets']
+
+  def __init__(self):
+    self.count = 0
+    self.total = 0
+    self.min = None
+    self.max = None
+    # maps the exponent of a bucket's upper bound to its count
+    self.buckets = {}
+
+  def Observe(self, value):
+    self.count += 1
+    self.total += value
+    if self.min is None or value < self.min:
+      self.min = value
+    if self.max is None or value > self.max:
+      self.max = value
+    exponent = int(value).bit_length() if value > 0 else 0
+    self.buckets[exponent] = self.buckets.get(exponent, 0) + 1
+
+  def Snapshot(self):
+    """Returns the histogram as a dict, with buckets keyed by upper bound."""
+    return {
+        'count': self.count,
+        'sum': self.total,
+        'min': self.min,
+        'max': self.max,
+        'mean': float(self.total) / self.count if self.count else None,
+        'buckets': dict((2 ** exponent, count)
+                        for exponent, count in self.buckets.items()),
+    }
+
+
+class Metrics(object):
+  """A thread-safe set of named counters and histograms."""
+
+  def __init__(self):
+    self._lock = threading.Lock()
+    self._counters = {}
+    self._histograms = {}
+
+  def Increment(self, name, count=1):
+    with self._lock:
+      self._counters[name] = self._counters.get(name, 0) + count
+
+  def Observe(self, name, value):
+    """Adds value to the histogram called name."""
+    with self._lock:
+      histogram = self._histograms.get(name)
+      if histogram is None:
+        histogram = self._histograms[name] = Histogram()
+      histogram.Observe(value)
+
+  def RecordTime(self, name, seconds):
+    """Counts a call to name, and adds its time in microseconds."""
+    with self._lock:
+      self._counters[name + '.calls'] = self._counters.get(name + '.calls', 0) + 1
+      histogram = self._histograms.get(name + '.us')
+      if histogram is None:
+        histogram = self._histograms[name + '.us'] = Histogram()
+      histogram.Observe(seconds * 1e6)
+
+  def TraceCallback(self):
+    """Returns a sqlite3 trace callback that counts statements by verb.
+
+    Connections only take one on Python 3.3 and later, where they have
+    set_trace_callback().
+    """
+    def trace(statement):
+      words = statement.split(None, 1)
+      self.Increment('sql.statements')
+      if words:
+        self.Increment('sql.' + words[0].upper())
+    return trace
+
+  def Snapshot(self):
+    """Returns all the counters and histograms as a dict."""
+    with self._lock:
+      return {
+          'counters': dict(self._counters),
+          'histograms': dict((name, histogram.Snapshot())
+                             for name, histogram in self._histograms.items()),
+      }
+
+  def Reset(self):
+    with self._lock:
+      self._counters = {}
+      self._histograms = {}
+
+
+def timed(name):
+  """Marks a method to be timed as name by instrument().
+
+  The method itself is left as it is, so it costs nothing until an object is
+  instrumented.
+  """
+  def decorator(method):
+    method._timed_name = name
+    return method
+  return decorator
+
+
+def _Timer(method, name, metrics):
+  @functools.wraps(method)
+  def wrapper(*args, **kwargs):
+    start = _timer()
+    try:
+      return method(*args, **kwargs)
+    finally:
+      metrics.RecordTime(name, _timer() - start)
+  return wrapper
+
+
+def instrument(obj, metrics):
+  """Times obj's timed() methods with metrics, or stops if it's None.
+
+  The timers are bound to obj itself, shadowing its class's methods, so
+  other objects of the class aren't affected.
+  """
+  cls = type(obj)
+  for attr in dir(cls):
+    name = getattr(getattr(cls, attr, None), '_timed_name', None)
+    if name is None:
+      continue
+    if metrics is None:
+      obj.__dict__.pop(attr, None)
+    else:
+      method = getattr(cls, attr).__get__(obj, cls)
+      obj.__dict__[attr] = _Timer(method, name, metrics)
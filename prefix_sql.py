@@ -1,8 +1,13 @@
 #!/usr/bin/env python
 
 import logging
+import math
 import random
 import sqlite3
+from operator import itemgetter
+
+from metrics import instrument, timed
+from random_streams import get_rng
 
 class MarkovPrefixSql(object):
 
@@ -27,7 +32,10 @@ class MarkovPrefixSql(object):
             initial INTEGER NOT NULL DEFAULT 0,
             FOREIGN KEY (prefix_id) REFERENCES prefixes(prefix_id)
         );""",
-        """CREATE INDEX IF NOT EXISTS leaf_prefix ON leaves(prefix_id);""",
+        """CREATE INDEX IF NOT EXISTS leaf_prefix_seen
+            ON leaves(prefix_id, num_seen DESC);""",
+        # leaf_prefix_seen covers every lookup the old index served
+        """DROP INDEX IF EXISTS leaf_prefix;""",
         """CREATE TABLE IF NOT EXISTS leaf_labels (
             leaf_label_id INTEGER PRIMARY KEY,
             leaf_id INTEGER NOT NULL,
@@ -43,14 +51,33 @@ class MarkovPrefixSql(object):
 
     ]
 
-    def __init__(self, max=4, min=None, separator=None, dbfile=None, ignore_duplicate_labels=True):
+    # Number of GetTopK() results kept before the cache is flushed.
+    TOPK_CACHE_SIZE = 4096
+
+    def __init__(self, max=4, min=None, separator=None, dbfile=None, ignore_duplicate_labels=True,
+                 metrics=None):
+        self._metrics = None
         self._max = max
         if min is not None and min != max:
             raise ValueError('Minimum must equal maximum for prefix chains')
         self._min = max
         self._separator = separator
         self._ignore_dupes = ignore_duplicate_labels
+        self._topk_cache = {}
         self.initDB(dbfile)
+        self.setMetrics(metrics)
+
+    def setMetrics(self, metrics):
+        """Starts reporting to a metrics.Metrics, or stops if it's None.
+
+        Statements are also counted by verb on Python 3.3 and later, where
+        sqlite3 has trace callbacks; Python 2's has none.
+        """
+        self._metrics = metrics
+        instrument(self, metrics)
+        if hasattr(self._prefixdb, 'set_trace_callback'):
+            self._prefixdb.set_trace_callback(
+                metrics.TraceCallback() if metrics is not None else None)
 
     def initDB(self, filename):
         if filename is None:
@@ -113,6 +140,38 @@ class MarkovPrefixSql(object):
     def _delMeta(self, key):
         self._cursor.execute("DELETE FROM metadata WHERE key = ?;", [key, ])
 
+    def stats(self):
+        """Returns the size of each table and index.
+
+        The result is a dict with:
+          rows: the number of rows in each table.
+          objects: the pages and bytes used by each table and index, or None
+            if SQLite was built without the dbstat virtual table.
+          page_size, page_count, freelist_count: from the PRAGMAs.
+        """
+        results = {'rows': {}}
+        tables = [row[0] for row in self._cursor.execute(
+            "SELECT name FROM sqlite_master WHERE type = 'table';")]
+        for table in tables:
+            for row in self._cursor.execute(
+                    'SELECT count(*) FROM "{}";'.format(table.replace('"', '""'))):
+                results['rows'][table] = row[0]
+
+        try:
+            results['objects'] = dict(
+                (name, {'pages': pages, 'bytes': size})
+                for name, pages, size in self._cursor.execute("""
+                    SELECT name, count(*), sum(pgsize) FROM dbstat
+                        GROUP BY name;"""))
+        except sqlite3.OperationalError:
+            results['objects'] = None
+
+        for pragma in ('page_size', 'page_count', 'freelist_count'):
+            for row in self._cursor.execute('PRAGMA {};'.format(pragma)):
+                results[pragma] = row[0]
+        return results
+
+    @timed('prefix_sql.Update')
     def Update(self, seq, label=None):
         subseq = seq[:self._max-1]
 
@@ -129,9 +188,14 @@ class MarkovPrefixSql(object):
         self._updateTuple(subseq, label, initial)
         if label is not None:
             self._markLabelSeen(label)
-        self._prefixdb.commit()
+        self._commit()
         return 1
 
+    @timed('prefix_sql.commit')
+    def _commit(self):
+        self._prefixdb.commit()
+
+    @timed('prefix_sql._isLabelSeen')
     def _isLabelSeen(self, label):
         label_str = str(label)
         results = self._cursor.execute("""
@@ -150,31 +214,35 @@ class MarkovPrefixSql(object):
         except sqlite3.OperationalError:
             pass
 
-    def _updateTuple(self, t, l, initial):
+    @timed('prefix_sql._updateTuple')
+    def _updateTuple(self, t, l, initial, count=1):
         prefix = t[0:self._max-1]
         if len(t) >= self._max:
             leaf = t[self._max-1]
         else:
             leaf = self._separator
 
-        prefix_id = self._getAndIncPrefixId(prefix)
-        self._getAndIncLeafId(prefix_id, leaf, l, initial)
+        if self._topk_cache:
+            self._topk_cache.clear()
+        prefix_id = self._getAndIncPrefixId(prefix, count)
+        self._getAndIncLeafId(prefix_id, leaf, l, initial, count)
 
-    def _getAndIncPrefixId(self, prefix):
+    def _getAndIncPrefixId(self, prefix, count=1):
         prefix_id = self._getPrefixId(prefix)
         if prefix_id is not None:
             self._cursor.execute("""
-                UPDATE prefixes SET num_seen = num_seen + 1
-                    WHERE prefix_id = ?; """, [prefix_id,]);
+                UPDATE prefixes SET num_seen = num_seen + ?
+                    WHERE prefix_id = ?; """, [count, prefix_id]);
         else:
             prefix_str = self._separator.join(prefix)
             self._cursor.execute("""
                 INSERT INTO prefixes(prefix, num_seen) VALUES (?, ?);""",
-                [prefix_str, 1])
+                [prefix_str, count])
             prefix_id = self._cursor.lastrowid
-            self._last_prefix_count = 1;
+            self._last_prefix_count = count;
         return prefix_id
 
+    @timed('prefix_sql._getPrefixId')
     def _getPrefixId(self, prefix):
         prefix_str = self._separator.join(prefix)
         results = self._cursor.execute("""
@@ -186,18 +254,18 @@ class MarkovPrefixSql(object):
         self._last_prefix_count = 0
         return None
 
-    def _getAndIncLeafId(self, prefix_id, suffix, label, initial):
+    def _getAndIncLeafId(self, prefix_id, suffix, label, initial, count=1):
         leaf_id = self._getLeafId(prefix_id, suffix)
         if leaf_id is not None:
             self._cursor.execute("""
-                UPDATE leaves SET num_seen = num_seen + 1
-                    WHERE leaf_id = ?;""", [leaf_id, ])
+                UPDATE leaves SET num_seen = num_seen + ?
+                    WHERE leaf_id = ?;""", [count, leaf_id])
         else:
             self._cursor.execute("""
                 INSERT INTO leaves(prefix_id, suffix, num_seen)
-                    VALUES(?, ?, ?);""", [prefix_id, suffix, 1])
+                    VALUES(?, ?, ?);""", [prefix_id, suffix, count])
             leaf_id = self._cursor.lastrowid
-            self._last_leaf_count = 1
+            self._last_leaf_count = count
         if initial:
             self._cursor.execute("""
                 UPDATE leaves SET initial = initial + 1
@@ -224,33 +292,35 @@ class MarkovPrefixSql(object):
         except sqlite3.OperationalError:
             pass
 
-    def GetRandomTuple(self, seed=None, depth=None, labelset=None, initial=False):
+    def GetRandomTuple(self, seed=None, depth=None, labelset=None, initial=False, rng=None):
         if depth is not None and depth != self._max:
             raise ValueError('depth!=max not supported in prefix chains')
+        rng = get_rng(rng)
 
         if seed is None:
             seed = []
 
         prefix = seed[:self._max-1]
         if len(prefix) < self._max - 1:
-            prefix_id, prefix = self._getPrefixIdLike(prefix, initial=initial)
+            prefix_id, prefix = self._getPrefixIdLike(prefix, initial=initial, rng=rng)
         else:
             prefix_id = self._getPrefixId(prefix)
 
         if prefix_id is None:
             return tuple(seed)
 
-        leaf_id, leaf = self._getRandomLeaf(prefix_id, labelset)
+        leaf_id, leaf = self._getRandomLeaf(prefix_id, labelset, rng)
 
         if leaf_id is not None:
             return tuple(prefix) + (leaf,)
         else:
             return tuple(prefix)
 
-    def GetInitialRandomTuple(self, seed=None, depth=None, labelset=None):
-        return self.GetRandomTuple(seed, depth, labelset, initial=True);
+    def GetInitialRandomTuple(self, seed=None, depth=None, labelset=None, rng=None):
+        return self.GetRandomTuple(seed, depth, labelset, initial=True, rng=rng);
 
-    def _getPrefixIdLike(self, prefix, initial=False):
+    @timed('prefix_sql._getPrefixIdLike')
+    def _getPrefixIdLike(self, prefix, initial=False, rng=random):
         if prefix:
             prefix_search_str = self._separator.join(prefix) + self._separator + '%'
         else:
@@ -270,16 +340,20 @@ class MarkovPrefixSql(object):
         results = self._cursor.execute(sql, [prefix_search_str,])
         prefix_map = {}
         total_count = 0
+        rows = 0
         for prefix_id, prefix_str, count in results:
+            rows += 1
             total_count += count
             # prefix_Id and prefix_str are not necessarily unique, so we catch collisions
             if (prefix_id, prefix_str) in prefix_map:
                 prefix_map[(prefix_id, prefix_str)] += count
             else:
                 prefix_map[(prefix_id, prefix_str)] = count
+        if self._metrics is not None:
+            self._metrics.Observe('prefix_sql._getPrefixIdLike.rows', rows)
         if total_count == 0:
             return None, None
-        target = random.randint(0, total_count-1)
+        target = rng.randint(0, total_count-1)
         for key, this_count in prefix_map.items():
             if target < this_count:
                 self._last_prefix_count = this_count
@@ -296,20 +370,24 @@ class MarkovPrefixSql(object):
         else:
             return list(string)
 
-    def _getRandomLeaf(self, prefix_id, labelset):
+    @timed('prefix_sql._getRandomLeaf')
+    def _getRandomLeaf(self, prefix_id, labelset, rng=random):
         assert self._last_prefix_count > 0, 'Didn\'t we find anything?'
-        target = random.randint(0, self._last_prefix_count - 1)
+        target = rng.randint(0, self._last_prefix_count - 1)
         results = self._cursor.execute("""
             SELECT leaf_id, suffix, num_seen FROM leaves
                 WHERE prefix_id = ?;""", [prefix_id,])
-        for leaf_id, suffix, count in results:
+        for rows, (leaf_id, suffix, count) in enumerate(results, 1):
             if target < count:
+                if self._metrics is not None:
+                    self._metrics.Observe('prefix_sql._getRandomLeaf.rows', rows)
                 self._updateLabelsFromLeaf(leaf_id, labelset)
                 return leaf_id, suffix
             else:
                 target -= count
         return None, None
 
+    @timed('prefix_sql._updateLabelsFromLeaf')
     def _updateLabelsFromLeaf(self, leaf_id, labelset):
         if labelset is None:
             return
@@ -318,24 +396,188 @@ class MarkovPrefixSql(object):
         for row in results:
             labelset.add(row[0])
 
-    def GetRandomSequence(self, seed=None, depth=None, labelset=None):
+    def GetTopK(self, prefix, k):
+        """Returns up to k (suffix, count) pairs most likely to follow prefix.
+
+        Only the last max-1 elements of prefix are used, and the end of
+        sequence marker is never returned.  As with tree.MarkovChain, a
+        shorter prefix, down to an empty one, gives the elements that
+        follow it in the tuples it starts, counted over all those tuples.
+
+        Raises:
+            ValueError: if k is negative.
+        """
+        if k < 0:
+            raise ValueError('k cannot be negative')
+        if len(prefix) > self._max-1:
+            prefix = prefix[len(prefix)-self._max+1:]
+        prefix = list(prefix)
+
+        key = (tuple(prefix), k)
+        if key in self._topk_cache:
+            return list(self._topk_cache[key])
+
+        if len(prefix) < self._max-1:
+            top = self._getTopKLike(prefix, k)
+        else:
+            top = self._getTopKLeaves(prefix, k)
+
+        if len(self._topk_cache) >= self.TOPK_CACHE_SIZE:
+            self._topk_cache.clear()
+        self._topk_cache[key] = top
+        return list(top)
+
+    def _getTopKLeaves(self, prefix, k):
+        prefix_id = self._getPrefixId(prefix)
+        if prefix_id is None:
+            return []
+        # leaf_prefix_seen hands back rows already in order
+        results = self._cursor.execute("""
+            SELECT suffix, num_seen FROM leaves
+                WHERE prefix_id = ? AND suffix != ?
+                ORDER BY num_seen DESC LIMIT ?;""",
+            [prefix_id, self._separator, k])
+        return [(suffix, count) for suffix, count in results]
+
+    def _getTopKLike(self, prefix, k):
+        # the element after a short prefix is inside the stored prefixes, so
+        # their counts are summed by that element
+        if prefix:
+            prefix_search_str = self._separator.join(prefix) + self._separator + '%'
+        else:
+            prefix_search_str = '%'
+        counts = {}
+        for prefix_str, count in self._cursor.execute("""
+                SELECT prefix, num_seen FROM prefixes WHERE prefix LIKE ?;""",
+                [prefix_search_str,]):
+            elements = prefix_str.split(self._separator)
+            # LIKE ignores case, and treats % and _ in elements as wildcards
+            if elements[:len(prefix)] == prefix:
+                element = elements[len(prefix)]
+                counts[element] = counts.get(element, 0) + count
+        return sorted(counts.items(), key=itemgetter(1), reverse=True)[:k]
+
+    def ScoreSequences(self, seqs, depth=None, per_token=False):
+        """Scores sequences by their log-probability under the chain.
+
+        The first max-1 elements of a sequence are scored together, on how
+        often they start a tuple, and that score is given to the first
+        element.  Each element after that is scored on the max-1 elements
+        before it.  Elements never seen in their context score -inf.  All
+        the counts for the batch are fetched with a single join.
+
+        Returns a list with the log-probability of each sequence, or, if
+        per_token is set, a list of (log-probability, [element
+        log-probabilities]) tuples.
+        """
+        if depth is not None and depth != self._max:
+            raise ValueError('Prefix mappings only support max depth')
+
+        width = self._max - 1
+        # maps (prefix string, suffix) to an index into the batch's counts,
+        # with a suffix of None for the initial prefix of a sequence
+        pairs = {}
+        seqs = [list(seq) for seq in seqs]
+        seq_pairs = []
+        for seq in seqs:
+            keys = []
+            if len(seq) >= width:
+                keys.append((self._separator.join(seq[:width]), None))
+            for ind in range(width, len(seq)):
+                keys.append((self._separator.join(seq[ind-width:ind]), seq[ind]))
+            for key in keys:
+                if key not in pairs:
+                    pairs[key] = len(pairs)
+            seq_pairs.append([pairs[key] for key in keys])
+
+        counts = self._getPairCounts(pairs)
+        for row in self._cursor.execute("SELECT total(num_seen) FROM prefixes;"):
+            total = row[0]
+
+        results = []
+        for seq, pair_ids in zip(seqs, seq_pairs):
+            if len(seq) >= width:
+                scores = [self._logRatio(counts[pair_ids[0]][0], total)]
+                scores += [0.0] * (width - 1)
+                for pair_id in pair_ids[1:]:
+                    prefix_count, leaf_count = counts[pair_id]
+                    scores.append(self._logRatio(leaf_count, prefix_count))
+            elif seq:
+                scores = [self._logRatio(self._countPrefixesLike(seq), total)]
+                scores += [0.0] * (len(seq) - 1)
+            else:
+                scores = []
+
+            if per_token:
+                results.append((sum(scores), scores))
+            else:
+                results.append(sum(scores))
+        return results
+
+    def _getPairCounts(self, pairs):
+        """Looks up the prefix and leaf counts of many (prefix, suffix) pairs.
+
+        Returns a list of (prefix count, leaf count) tuples, indexed by the
+        values of pairs.
+        """
+        self._cursor.execute("""
+            CREATE TEMP TABLE IF NOT EXISTS score_pairs (
+                pair_id INTEGER PRIMARY KEY,
+                prefix TEXT NOT NULL,
+                suffix TEXT
+            );""")
+        counts = [(0, 0)] * len(pairs)
+        try:
+            self._cursor.executemany("""
+                INSERT INTO score_pairs(pair_id, prefix, suffix) VALUES(?, ?, ?);""",
+                [(pair_id, prefix, suffix) for (prefix, suffix), pair_id in pairs.items()])
+            results = self._cursor.execute("""
+                SELECT s.pair_id, p.num_seen, l.num_seen
+                    FROM score_pairs s
+                    LEFT JOIN prefixes p ON p.prefix = s.prefix
+                    LEFT JOIN leaves l
+                        ON l.prefix_id = p.prefix_id AND l.suffix = s.suffix;""")
+            for pair_id, prefix_count, leaf_count in results:
+                counts[pair_id] = (prefix_count or 0, leaf_count or 0)
+        finally:
+            # rows left behind by a failed batch would collide with the next
+            self._cursor.execute("DELETE FROM score_pairs;")
+            self._commit()
+        return counts
+
+    def _countPrefixesLike(self, prefix):
+        prefix_search_str = self._separator.join(prefix) + self._separator + '%'
+        for row in self._cursor.execute("""
+                SELECT total(num_seen) FROM prefixes WHERE prefix LIKE ?;""",
+                [prefix_search_str,]):
+            return row[0]
+
+    @staticmethod
+    def _logRatio(numerator, denominator):
+        if not numerator or not denominator:
+            return float('-inf')
+        return math.log(float(numerator) / denominator)
+
+    def GetRandomSequence(self, seed=None, depth=None, labelset=None, rng=None):
         if depth is not None and depth != self._max:
             raise ValueError('Prefix mappings only support max depth')
+        rng = get_rng(rng)
 
         while seed and len(seed) >= self._max:
             yield seed[0]
             seed = seed[1:]
 
-        seed_tuple = self.GetRandomTuple(seed, labelset=labelset)
+        seed_tuple = self.GetRandomTuple(seed, labelset=labelset, rng=rng)
         while len(seed_tuple) >= self._max:
             yield seed_tuple[0]
-            seed_tuple = self.GetRandomTuple(seed=seed_tuple[1:], labelset=labelset)
+            seed_tuple = self.GetRandomTuple(seed=seed_tuple[1:], labelset=labelset, rng=rng)
         for extra in seed_tuple:
             yield extra
 
-    def GetAnnotatedSequence(self, seed=None, depth=None):
+    def GetAnnotatedSequence(self, seed=None, depth=None, rng=None):
         if depth is not None and depth != self._max:
             raise ValueError('Prefix mappings only support max depth')
+        rng = get_rng(rng)
 
         while seed and len(seed) >= self._max:
             seq = seed[:self._max]
@@ -345,17 +587,18 @@ class MarkovPrefixSql(object):
 
         labelset = set()
         old_labels = labelset
-        seq = self.GetRandomTuple(seed, labelset=labelset)
+        seq = self.GetRandomTuple(seed, labelset=labelset, rng=rng)
         while len(seq) >= self._max:
             yield seq[0], labelset
             # this implementation doesn't find labels at the end state, so we save them
             old_labels = labelset
             labelset = set()
-            seq = self.GetRandomTuple(seq[1:], labelset=labelset)
+            seq = self.GetRandomTuple(seq[1:], labelset=labelset, rng=rng)
 
         for element in seq:
             yield element, old_labels
 
+    @timed('prefix_sql._getLabels')
     def _getLabels(self, seq):
         prefix = seq[:self._max-1]
         leaf = seq[self._max-1]
@@ -0,0 +1,85 @@
+#!/usr/bin/env python
+
+import math
+import sqlite3
+import unittest
+
+import metrics
+from prefix_sql import MarkovPrefixSql
+import tree
+
+class MarkovPrefixSqlTest(unittest.TestCase):
+    def setUp(self):
+        self.chain = MarkovPrefixSql(max=2)
+        for seq in ('a b', 'a b', 'a c', 'a d d'):
+            self.chain.Update(seq.split())
+
+    def testGetTopK(self):
+        self.assertEqual([('b', 2), ('c', 1)], self.chain.GetTopK(['a'], 2))
+        self.assertEqual([], self.chain.GetTopK(['q'], 2))
+        self.assertEqual([('a', 4)], self.chain.GetTopK([], 1),
+                         'An empty prefix should give the first elements')
+        self.assertRaises(ValueError, self.chain.GetTopK, ['a'], -1)
+
+        self.chain.Update('a c'.split())
+        self.chain.Update('a c'.split())
+        self.assertEqual([('c', 3)], self.chain.GetTopK(['a'], 1),
+                         'Cached results not invalidated by Update()')
+
+    def testGetTopKShortPrefix(self):
+        chain = MarkovPrefixSql(max=3)
+        tree_chain = tree.MarkovChain(max=3)
+        for seq in ('a b c', 'a b d', 'a c d', 'A b c', 'a_ b c'):
+            chain.Update(seq.split())
+            tree_chain.Update(seq.split())
+        self.assertEqual([('b', 2), ('c', 1)], chain.GetTopK(['a'], 5),
+                         'Only prefixes starting with the element should count')
+        for prefix in ([], ['a'], ['A'], ['b'], ['q']):
+            self.assertEqual(sorted(tree_chain.GetTopK(prefix, 5)),
+                             sorted(chain.GetTopK(prefix, 5)))
+
+    def testScoreSequences(self):
+        scores = self.chain.ScoreSequences([['a', 'b'], ['a', 'd', 'd'], ['a', 'q']],
+                                           per_token=True)
+        # prefixes: a (4), b (2), c (1), d (2)
+        self.assertAlmostEqual(math.log(4.0/9) + math.log(2.0/4), scores[0][0])
+        self.assertEqual(2, len(scores[0][1]))
+        self.assertAlmostEqual(math.log(4.0/9) + math.log(1.0/4) + math.log(1.0/2),
+                               scores[1][0])
+        self.assertEqual(float('-inf'), scores[2][0])
+        self.assertEqual([scores[0][0]], self.chain.ScoreSequences([['a', 'b']]))
+
+    def testScoreSequencesAfterError(self):
+        self.assertRaises(sqlite3.InterfaceError, self.chain.ScoreSequences,
+                          [['a', 'b', 'c', object()]])
+        self.assertAlmostEqual(math.log(4.0/9) + math.log(2.0/4),
+                               self.chain.ScoreSequences([['a', 'b']])[0],
+                               'A failed batch should not break later ones')
+
+    def testMetrics(self):
+        m = metrics.Metrics()
+        self.chain.setMetrics(m)
+        self.chain.Update('a b c'.split())
+        self.chain.GetRandomTuple()
+        self.chain.setMetrics(None)
+        self.chain.Update('a b c'.split())
+        self.assertFalse('Update' in vars(self.chain),
+                         'Timers should be removed with the metrics')
+
+        snapshot = m.Snapshot()
+        self.assertEqual(1, snapshot['counters']['prefix_sql.Update.calls'])
+        self.assertEqual(1, snapshot['counters']['prefix_sql.commit.calls'])
+        self.assertEqual(3, snapshot['counters']['prefix_sql._updateTuple.calls'])
+        self.assertTrue('prefix_sql._getPrefixIdLike.rows' in snapshot['histograms'])
+        self.assertTrue('prefix_sql._getRandomLeaf.us' in snapshot['histograms'])
+
+    def testStats(self):
+        stats = self.chain.stats()
+        self.assertEqual(4, stats['rows']['prefixes'])
+        self.assertEqual(7, stats['rows']['leaves'])
+        self.assertTrue(stats['page_count'] > 0)
+        if stats['objects'] is not None:
+            self.assertTrue('leaf_prefix_seen' in stats['objects'])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,105 @@
+#!/usr/bin/python
+
+"""Random number streams for generating from markov chains.
+
+The generation methods of every chain take an optional rng argument, which
+may be None (use the global random module), an integer seed, a
+random.Random, or a NumPy Generator or RandomState.  get_rng() turns any of
+these into an object with the uniform() and randint() methods the chains
+call, and the public generation methods call it once on the way in.
+
+Seeds always give a random.Random, so that a seed produces the same output
+whether or not NumPy is installed.  spawn() derives any number of
+independent seeded streams from one seed, one per worker or per job, so
+parallel generation needs no shared state and is reproducible.
+"""
+
+import hashlib
+import numbers
+import random
+
+# Most values a BlockRandom draws from its source at a time.
+BLOCK_SIZE = 1024
+
+
+def _Sampler(source):
+  """Returns source's method for drawing an array of floats in [0, 1)."""
+  # a RandomState's is random_sample(size); NumPy 1.17 added the Generator,
+  # whose is random(size)
+  sampler = getattr(source, 'random_sample', None)
+  if sampler is None:
+    sampler = getattr(source, 'random', None)
+  return sampler
+
+
+class BlockRandom(object):
+  """Hands out values from a source that's cheap to draw from in bulk.
+
+  NumPy sources cost far more per call than per value, so values are drawn
+  a block at a time, and each call only costs a list lookup.  Blocks start
+  small and double up to block_size, so a BlockRandom that's only used for a
+  few values doesn't throw most of a block away.  The values are the same
+  whatever the block sizes are.
+  """
+
+  __slots__ = ['_sampler', '_block_size', '_next_size', '_block', '_pos']
+
+  def __init__(self, source, block_size=BLOCK_SIZE):
+    """Arguments:
+      source: a NumPy Generator or RandomState, or anything else with a
+        random(size) method returning an array of floats in [0, 1).
+      block_size: most values to draw at a time.
+    """
+    self._sampler = _Sampler(source)
+    self._block_size = block_size
+    self._next_size = 1
+    self._block = []
+    self._pos = 0
+
+  def random(self):
+    if self._pos >= len(self._block):
+      self._block = list(self._sampler(self._next_size))
+      self._next_size = min(self._next_size * 2, self._block_size)
+      self._pos = 0
+    value = self._block[self._pos]
+    self._pos += 1
+    return value
+
+  def uniform(self, a, b):
+    return a + (b - a) * self.random()
+
+  def randint(self, a, b):
+    return a + int(self.random() * (b - a + 1))
+
+
+def get_rng(rng=None):
+  """Returns a source of random numbers for rng.
+
+  Arguments:
+    rng: None, an integer seed, a random.Random, a BlockRandom, or a NumPy
+      Generator or RandomState.
+
+  Raises:
+    TypeError: if rng is none of the above.
+  """
+  if rng is None:
+    return random
+  if rng is random or isinstance(rng, (random.Random, BlockRandom)):
+    return rng
+  if isinstance(rng, numbers.Integral):
+    return random.Random(rng)
+  # NumPy's randint() excludes its upper bound, so it's always wrapped
+  if _Sampler(rng) is not None:
+    return BlockRandom(rng)
+  raise TypeError('Can\'t use {!r} as a random number generator'.format(rng))
+
+
+def stream(seed, index):
+  """Returns the index'th independent random.Random derived from seed."""
+  digest = hashlib.sha256('{}:{}'.format(seed, index)).hexdigest()
+  return random.Random(int(digest, 16))
+
+
+def spawn(seed, count):
+  """Returns count independent random.Random streams derived from seed."""
+  return [stream(seed, index) for index in xrange(count)]
@@ -0,0 +1,62 @@
+#!/usr/bin/python
+
+import random
+import unittest
+
+try:
+  import numpy
+except ImportError:
+  numpy = None
+
+import random_streams
+
+class _FakeGenerator(object):
+  """Stands in for a NumPy Generator."""
+
+  def __init__(self, seed):
+    self._random = random.Random(seed)
+    self.calls = 0
+
+  def random(self, size):
+    self.calls += 1
+    return [self._random.random() for _ in xrange(size)]
+
+class RandomStreamsTest(unittest.TestCase):
+  def testGetRng(self):
+    self.assertTrue(random_streams.get_rng(None) is random,
+                    "None should use the global random module")
+    rng = random.Random(5)
+    self.assertTrue(random_streams.get_rng(rng) is rng)
+    self.assertEqual(random.Random(5).random(),
+                     random_streams.get_rng(5).random(),
+                     "Seeds should give a seeded random.Random")
+    self.assertRaises(TypeError, random_streams.get_rng, 'seed')
+
+  def testBlockRandom(self):
+    source = _FakeGenerator(7)
+    rng = random_streams.get_rng(source)
+    expected = random.Random(7)
+    for _ in xrange(10):
+      self.assertEqual(expected.random(), rng.random())
+    self.assertEqual(4, source.calls, "Blocks should double in size")
+    for _ in xrange(3000):
+      self.assertEqual(expected.random(), rng.random())
+    self.assertEqual(12, source.calls, "Blocks should stop at BLOCK_SIZE")
+    for _ in xrange(1000):
+      self.assertTrue(3 <= rng.randint(3, 5) <= 5, "randint out of range")
+
+  def testRandomState(self):
+    if numpy is None:
+      self.skipTest('numpy is not installed')
+    rng = random_streams.get_rng(numpy.random.RandomState(3))
+    expected = numpy.random.RandomState(3).random_sample(2000)
+    self.assertEqual(list(expected), [rng.random() for _ in xrange(2000)])
+
+  def testSpawn(self):
+    first = [rng.random() for rng in random_streams.spawn(42, 4)]
+    second = [rng.random() for rng in random_streams.spawn(42, 4)]
+    self.assertEqual(first, second, "Streams should be reproducible")
+    self.assertEqual(4, len(set(first)), "Streams should differ")
+
+if __name__ == "__main__":
+  unittest.main()
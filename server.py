@@ -0,0 +1,449 @@
+#!/usr/bin/python
+
+"""Serves generation, annotation and scoring from a trained chain.
+
+Requests are JSON, either POSTed to /generate, /annotate or /score over
+HTTP on localhost, or sent one per line over a Unix socket with an "op"
+field naming the operation.  GET /stats, or the "stats" op, returns the
+server's own latency, batch size and queue depth figures.
+
+Connection threads don't touch the chain themselves.  They queue their
+request and wait for it, with a timeout.  A dispatcher thread takes every
+request that is waiting at the time, up to batch_size of them, and hands
+them to a fixed number of worker threads.  Score requests are grouped, so
+that one worker scores them all with a single ScoreSequences() call, while
+generate and annotate requests are handed out one at a time, so that a
+burst of them is spread over every worker.  Each worker calls
+chain_factory once, so for a MarkovPrefixSql each one should open its own
+connection to the database file:
+
+  srv = server.GenerationServer(
+      lambda: prefix_sql.MarkovPrefixSql(max=3, dbfile='chain.db'))
+  srv.Start()
+  httpd = server.MakeHTTPServer(srv, port=8080)
+  httpd.serve_forever()
+
+A tree.MarkovChain can be shared by every worker, as long as nothing
+updates it while it's being served.
+
+Generate and annotate requests take an optional "seed" sequence, a "max_tokens"
+limit, which the server's own limit caps, and an "rng" seed.  Score requests
+take a "sequence", and "per_token" to get each element's score as well.
+"""
+
+import argparse
+import BaseHTTPServer
+import json
+import os
+import Queue
+import SocketServer
+import sys
+import threading
+from timeit import default_timer as _timer
+
+import metrics as metrics_module
+
+OPS = ('generate', 'annotate', 'score')
+
+
+class Overloaded(Exception):
+  """Raised when the request queue is full."""
+
+
+class RequestTimeout(Exception):
+  """Raised when a request isn't served before its deadline."""
+
+
+class _Request(object):
+  __slots__ = ['op', 'params', 'start', 'deadline', 'done', 'result', 'error']
+
+  def __init__(self, op, params, timeout):
+    self.op = op
+    self.params = params
+    self.start = _timer()
+    self.deadline = self.start + timeout
+    self.done = threading.Event()
+    self.result = None
+    self.error = None
+
+
+def _json_score(score):
+  # -inf isn't valid JSON
+  return None if score == float('-inf') else score
+
+
+class GenerationServer(object):
+  """Coalesces concurrent requests and serves them from a pool of chains."""
+
+  def __init__(self, chain_factory, workers=4, max_tokens=1000, timeout=5.0,
+               batch_size=32, max_queue=1024, metrics=None):
+    """Build a new server.  Nothing is served until Start() is called.
+
+    Arguments:
+      chain_factory: called once by each worker thread to get its chain.
+      workers: number of worker threads, and so of chains.
+      max_tokens: most elements generated for any one request.
+      timeout: seconds a request may take, from being queued to being done.
+      batch_size: most requests taken from the queue at once, and so most
+        score requests scored together.
+      max_queue: requests queued beyond this are refused with Overloaded.
+      metrics: (optional) a metrics.Metrics to report to, instead of a new
+        one.
+    """
+    self.chain_factory = chain_factory
+    self.workers = workers
+    self.max_tokens = max_tokens
+    self.timeout = timeout
+    self.batch_size = batch_size
+    self.max_queue = max_queue
+    if metrics is None:
+      metrics = metrics_module.Metrics()
+    self.metrics = metrics
+    self._requests = Queue.Queue()
+    # bounded, so the dispatcher waits for a free worker rather than
+    # building up a second queue
+    self._batches = Queue.Queue(maxsize=workers)
+    self._threads = []
+
+  def Start(self):
+    """Starts the dispatcher and worker threads."""
+    ready = []
+    for _ in xrange(self.workers):
+      ready.append(threading.Event())
+      self._threads.append(threading.Thread(target=self._Work,
+                                            args=(ready[-1],)))
+    self._threads.append(threading.Thread(target=self._Dispatch))
+    for thread in self._threads:
+      thread.daemon = True
+      thread.start()
+    for event in ready:
+      event.wait()
+
+  def Stop(self):
+    """Serves whatever is already queued, then stops every thread."""
+    self._requests.put(None)
+    for thread in self._threads:
+      thread.join()
+    self._threads = []
+
+  def Submit(self, op, params):
+    """Queues a request, and returns it without waiting for it."""
+    if op not in OPS:
+      raise ValueError('Unknown operation {!r}'.format(op))
+    depth = self._requests.qsize()
+    self.metrics.Observe('server.queue_depth', depth)
+    if depth >= self.max_queue:
+      self.metrics.Increment('server.overloaded')
+      raise Overloaded('{} requests already queued'.format(depth))
+    request = _Request(op, params, self.timeout)
+    self._requests.put(request)
+    return request
+
+  def Call(self, op, params):
+    """Serves a request, and returns its result.
+
+    Raises:
+      ValueError: the request is malformed.
+      Overloaded: too many requests are already queued.
+      RequestTimeout: the request wasn't done in time.
+    """
+    request = self.Submit(op, params)
+    request.done.wait(max(0, request.deadline - _timer()))
+    if not request.done.is_set():
+      self.metrics.Increment('server.timeouts')
+      raise RequestTimeout('{} took over {}s'.format(op, self.timeout))
+    if request.error is not None:
+      raise request.error
+    return request.result
+
+  def Stats(self):
+    """Returns the server's metrics, with its current queue depths."""
+    snapshot = self.metrics.Snapshot()
+    snapshot['queued'] = self._requests.qsize()
+    snapshot['batches_queued'] = self._batches.qsize()
+    return snapshot
+
+  def _Dispatch(self):
+    stopping = False
+    while not stopping:
+      batch = [self._requests.get()]
+      while len(batch) < self.batch_size:
+        try:
+          batch.append(self._requests.get_nowait())
+        except Queue.Empty:
+          break
+      if None in batch:
+        stopping = True
+        batch = [request for request in batch if request is not None]
+        # anything queued after the stop is still served
+        while True:
+          try:
+            batch.append(self._requests.get_nowait())
+          except Queue.Empty:
+            break
+
+      scores = [request for request in batch if request.op == 'score']
+      if scores:
+        self.metrics.Observe('server.batch_size', len(scores))
+        self._batches.put(('score', scores))
+      for request in batch:
+        if request.op != 'score':
+          self._batches.put((request.op, [request]))
+    for _ in xrange(self.workers):
+      self._batches.put(None)
+
+  def _Work(self, ready):
+    chain = self.chain_factory()
+    ready.set()
+    while True:
+      batch = self._batches.get()
+      if batch is None:
+        return
+      op, requests = batch
+      live = []
+      for request in requests:
+        if _timer() > request.deadline:
+          # the caller has already given up
+          self.metrics.Increment('server.expired')
+        else:
+          live.append(request)
+      if op == 'score':
+        self._Score(chain, live)
+      else:
+        for request in live:
+          self._Serve(chain, op, request)
+      for request in live:
+        if request.error is not None:
+          self.metrics.Increment('server.errors')
+        self.metrics.RecordTime('server.' + op, _timer() - request.start)
+        request.done.set()
+
+  def _Limit(self, request):
+    limit = request.params.get('max_tokens', self.max_tokens)
+    if not isinstance(limit, (int, long)) or limit < 0:
+      raise ValueError('max_tokens must be a non-negative integer')
+    return min(limit, self.max_tokens)
+
+  @staticmethod
+  def _CheckSequence(sequence, name):
+    if not isinstance(sequence, list):
+      raise ValueError('{} must be a list'.format(name))
+    for element in sequence:
+      if isinstance(element, (list, dict)):
+        raise ValueError('{} must only hold strings and numbers'.format(name))
+
+  def _Serve(self, chain, op, request):
+    try:
+      limit = self._Limit(request)
+      seed = request.params.get('seed')
+      if seed is not None:
+        self._CheckSequence(seed, 'seed')
+        seed = tuple(seed)
+      rng = request.params.get('rng')
+      if rng is not None and (not isinstance(rng, (int, long)) or
+                              isinstance(rng, bool)):
+        raise ValueError('rng must be an integer seed')
+      if op == 'generate':
+        sequence = chain.GetRandomSequence(seed, rng=rng)
+      else:
+        sequence = chain.GetAnnotatedSequence(seed, rng=rng)
+
+      elements = []
+      truncated = False
+      for element in sequence:
+        # only a sequence with an element past the limit was cut short
+        if len(elements) >= limit:
+          truncated = True
+          break
+        if _timer() > request.deadline:
+          raise RequestTimeout('generation ran past the deadline')
+        if op == 'annotate':
+          # labels are None for a seed that isn't in the chain
+          element = [element[0], sorted(element[1] or ())]
+        elements.append(element)
+      request.result = {'sequence': elements, 'truncated': truncated}
+    except Exception as e:
+      request.error = e
+
+  def _Score(self, chain, requests):
+    seqs = []
+    for request in requests:
+      sequence = request.params.get('sequence')
+      try:
+        self._CheckSequence(sequence, 'sequence')
+        if len(sequence) > self.max_tokens:
+          raise ValueError('sequence is longer than {} tokens'.format(
+              self.max_tokens))
+      except ValueError as e:
+        request.error = e
+      else:
+        seqs.append(sequence)
+    requests = [request for request in requests if request.error is None]
+    if not requests:
+      return
+
+    try:
+      scores = chain.ScoreSequences(seqs, per_token=True)
+    except Exception as e:
+      for request in requests:
+        request.error = e
+      return
+    for request, (score, per_token) in zip(requests, scores):
+      request.result = {'score': _json_score(score)}
+      if request.params.get('per_token'):
+        request.result['per_token'] = [_json_score(token_score)
+                                       for token_score in per_token]
+
+
+def _Respond(srv, op, params):
+  """Serves one request, and returns (HTTP status, response dict)."""
+  if op == 'stats':
+    return 200, srv.Stats()
+  if not isinstance(params, dict):
+    return 400, {'error': 'request must be a JSON object'}
+  try:
+    return 200, srv.Call(op, params)
+  except ValueError as e:
+    return 400, {'error': str(e)}
+  except Overloaded as e:
+    return 503, {'error': str(e)}
+  except RequestTimeout as e:
+    return 504, {'error': str(e)}
+  except Exception as e:
+    return 500, {'error': repr(e)}
+
+
+class _HTTPHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+  protocol_version = 'HTTP/1.1'
+
+  def _Send(self, status, response):
+    body = json.dumps(response)
+    self.send_response(status)
+    self.send_header('Content-Type', 'application/json')
+    self.send_header('Content-Length', str(len(body)))
+    self.end_headers()
+    self.wfile.write(body)
+
+  def do_GET(self):
+    if self.path == '/stats':
+      self._Send(*_Respond(self.server.generation_server, 'stats', None))
+    else:
+      self._Send(404, {'error': 'not found'})
+
+  def do_POST(self):
+    op = self.path.strip('/')
+    body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+    if op not in OPS:
+      self._Send(404, {'error': 'not found'})
+      return
+    try:
+      params = json.loads(body) if body else {}
+    except ValueError:
+      self._Send(400, {'error': 'request body is not valid JSON'})
+      return
+    self._Send(*_Respond(self.server.generation_server, op, params))
+
+  def log_message(self, format, *args):
+    pass
+
+
+class _HTTPServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+  daemon_threads = True
+
+
+class _LineHandler(SocketServer.StreamRequestHandler):
+  def handle(self):
+    for line in iter(self.rfile.readline, ''):
+      if not line.strip():
+        continue
+      try:
+        params = json.loads(line)
+      except ValueError:
+        status, response = 400, {'error': 'request is not valid JSON'}
+      else:
+        op = params.pop('op', None) if isinstance(params, dict) else None
+        status, response = _Respond(self.server.generation_server, op, params)
+      response['status'] = status
+      self.wfile.write(json.dumps(response) + '\n')
+      self.wfile.flush()
+
+
+class _UnixServer(SocketServer.ThreadingMixIn,
+                  SocketServer.UnixStreamServer):
+  daemon_threads = True
+
+
+def MakeHTTPServer(srv, port, host='localhost'):
+  """Returns an HTTP server for srv, ready for serve_forever()."""
+  httpd = _HTTPServer((host, port), _HTTPHandler)
+  httpd.generation_server = srv
+  return httpd
+
+
+def MakeUnixServer(srv, path):
+  """Returns a Unix socket server for srv, ready for serve_forever().
+
+  Each connection sends one JSON request per line, with an "op" field, and
+  gets one JSON response per line, with a "status" field.
+  """
+  if os.path.exists(path):
+    os.unlink(path)
+  unix_server = _UnixServer(path, _LineHandler)
+  unix_server.generation_server = srv
+  return unix_server
+
+
+def main(argv):
+  parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+  source = parser.add_mutually_exclusive_group(required=True)
+  source.add_argument('--dbfile', help='serve this prefix_sql database')
+  source.add_argument('--train', help='serve a tree trained on the blank '
+                      'line separated paragraphs of this file')
+  parser.add_argument('--max', type=int, default=3, help='chain max')
+  listen = parser.add_mutually_exclusive_group(required=True)
+  listen.add_argument('--port', type=int, help='serve HTTP on localhost')
+  listen.add_argument('--socket', help='serve on this Unix socket')
+  parser.add_argument('--workers', type=int, default=4)
+  parser.add_argument('--max-tokens', type=int, default=1000)
+  parser.add_argument('--timeout', type=float, default=5.0)
+  args = parser.parse_args(argv)
+
+  if args.dbfile:
+    import prefix_sql
+    factory = lambda: prefix_sql.MarkovPrefixSql(max=args.max,
+                                                 dbfile=args.dbfile)
+  else:
+    import tree
+    chain = tree.MarkovChain(max=args.max)
+    para = []
+    with open(args.train) as fh:
+      for line in fh:
+        if line.isspace():
+          if para:
+            chain.Update(para)
+          para = []
+        else:
+          para.extend(line.split())
+    if para:
+      chain.Update(para)
+    factory = lambda: chain
+
+  srv = GenerationServer(factory, workers=args.workers,
+                         max_tokens=args.max_tokens, timeout=args.timeout)
+  srv.Start()
+  if args.port:
+    listener = MakeHTTPServer(srv, args.port)
+  else:
+    listener = MakeUnixServer(srv, args.socket)
+  try:
+    listener.serve_forever()
+  except KeyboardInterrupt:
+    pass
+  finally:
+    listener.server_close()
+    srv.Stop()
+  return 0
+
+
+if __name__ == '__main__':
+  sys.exit(main(sys.argv[1:]))
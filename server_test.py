@@ -0,0 +1,193 @@
+#!/usr/bin/python
+
+import httplib
+import json
+import os
+import shutil
+import socket
+import tempfile
+import threading
+import time
+import unittest
+
+from prefix_sql import MarkovPrefixSql
+import server
+import tree
+
+class GenerationServerTest(unittest.TestCase):
+  def setUp(self):
+    self.chain = tree.MarkovChain(max=3)
+    self.chain.Update('the cat sat on the mat'.split(), label='cat')
+    self.chain.Update('the dog sat on the log'.split(), label='dog')
+    self.srv = server.GenerationServer(lambda: self.chain, workers=2,
+                                       max_tokens=4)
+    self.srv.Start()
+
+  def tearDown(self):
+    self.srv.Stop()
+
+  def testGenerate(self):
+    result = self.srv.Call('generate', {'seed': ['the', 'cat'], 'rng': 7})
+    self.assertEqual(['the', 'cat', 'sat', 'on'], result['sequence'])
+    self.assertTrue(result['truncated'], "Server limit should cap the length")
+    result = self.srv.Call('generate', {'seed': ['the', 'cat'],
+                                        'max_tokens': 2})
+    self.assertEqual(['the', 'cat'], result['sequence'])
+    self.assertTrue(result['truncated'])
+    chain = tree.MarkovChain(max=3)
+    chain.Update('the cat sat'.split())
+    srv = server.GenerationServer(lambda: chain, max_tokens=3)
+    srv.Start()
+    try:
+      result = srv.Call('generate', {'seed': ['the', 'cat']})
+    finally:
+      srv.Stop()
+    self.assertEqual(['the', 'cat', 'sat'], result['sequence'])
+    self.assertFalse(result['truncated'],
+                     "A sequence ending at the limit wasn't cut short")
+    self.assertRaises(ValueError, self.srv.Call, 'generate',
+                      {'max_tokens': -1})
+    self.assertRaises(ValueError, self.srv.Call, 'train', {})
+
+  def testAnnotate(self):
+    result = self.srv.Call('annotate', {'seed': ['the', 'dog', 'sat']})
+    self.assertEqual(['the', ['dog']], result['sequence'][0])
+
+  def testScore(self):
+    expected = self.chain.ScoreSequences([['the', 'cat', 'sat']],
+                                         per_token=True)[0]
+    result = self.srv.Call('score', {'sequence': ['the', 'cat', 'sat'],
+                                     'per_token': True})
+    self.assertAlmostEqual(expected[0], result['score'])
+    self.assertEqual(3, len(result['per_token']))
+    self.assertEqual(None, self.srv.Call(
+        'score', {'sequence': ['the', 'cow']})['score'],
+        "Unseen sequences should score None rather than -inf")
+
+  def testCoalescing(self):
+    srv = server.GenerationServer(lambda: self.chain, batch_size=8)
+    # queued before starting, so they're all waiting for the dispatcher
+    requests = [srv.Submit('score', {'sequence': ['the', 'cat', 'sat']})
+                for _ in xrange(20)]
+    srv.Start()
+    try:
+      for request in requests:
+        request.done.wait(5)
+        self.assertEqual(None, request.error)
+    finally:
+      srv.Stop()
+    stats = srv.Stats()
+    self.assertEqual(20, stats['counters']['server.score.calls'])
+    self.assertEqual(3, stats['histograms']['server.batch_size']['count'],
+                     "Queued requests should be served together")
+    self.assertEqual(19, stats['histograms']['server.queue_depth']['max'])
+
+  def testBadInput(self):
+    self.assertRaises(ValueError, self.srv.Call, 'generate', {'rng': 'x'})
+    self.assertRaises(ValueError, self.srv.Call, 'generate', {'seed': 'the'})
+    self.assertRaises(ValueError, self.srv.Call, 'score',
+                      {'sequence': ['the', ['cat']]})
+    result = self.srv.Call('annotate', {'seed': ['a', 'cow', 'sat', 'on']})
+    self.assertEqual(['a', []], result['sequence'][0],
+                     "A seed not in the chain should have no labels")
+
+  def testGenerateSpreadOverWorkers(self):
+    chain = self.chain
+    class SlowChain(object):
+      def GetRandomSequence(self, seed=None, rng=None):
+        time.sleep(0.2)
+        return chain.GetRandomSequence(seed, rng=rng)
+    srv = server.GenerationServer(SlowChain, workers=4)
+    requests = [srv.Submit('generate', {'seed': ['the']}) for _ in xrange(8)]
+    start = time.time()
+    srv.Start()
+    try:
+      for request in requests:
+        request.done.wait(5)
+    finally:
+      srv.Stop()
+    # two rounds of four, rather than eight on one worker
+    self.assertTrue(time.time() - start < 1.0)
+
+  def testLimits(self):
+    self.srv.max_queue = 0
+    self.assertRaises(server.Overloaded, self.srv.Call, 'generate', {})
+    self.srv.max_queue = 1024
+    self.srv.timeout = 0
+    self.assertRaises(server.RequestTimeout, self.srv.Call, 'generate', {})
+
+  def testHTTP(self):
+    httpd = server.MakeHTTPServer(self.srv, port=0)
+    thread = threading.Thread(target=httpd.serve_forever)
+    thread.start()
+    try:
+      conn = httplib.HTTPConnection('localhost', httpd.server_address[1])
+      conn.request('POST', '/generate', json.dumps({'seed': ['the', 'dog'],
+                                                    'max_tokens': 3}))
+      response = conn.getresponse()
+      self.assertEqual(200, response.status)
+      self.assertEqual(['the', 'dog', 'sat'],
+                       json.loads(response.read())['sequence'])
+      conn.request('GET', '/stats')
+      response = conn.getresponse()
+      self.assertEqual(200, response.status)
+      self.assertTrue('counters' in json.loads(response.read()))
+      conn.request('POST', '/score', '{}')
+      response = conn.getresponse()
+      response.read()
+      self.assertEqual(400, response.status)
+      conn.close()
+    finally:
+      httpd.shutdown()
+      httpd.server_close()
+      thread.join()
+
+  def testUnixSocket(self):
+    tmpdir = tempfile.mkdtemp()
+    path = os.path.join(tmpdir, 'markov.sock')
+    unix_server = server.MakeUnixServer(self.srv, path)
+    thread = threading.Thread(target=unix_server.serve_forever)
+    thread.start()
+    try:
+      sock = socket.socket(socket.AF_UNIX)
+      sock.connect(path)
+      fh = sock.makefile()
+      fh.write(json.dumps({'op': 'generate', 'seed': ['the', 'cat'],
+                           'max_tokens': 3}) + '\n')
+      fh.write('not json\n')
+      fh.flush()
+      first = json.loads(fh.readline())
+      self.assertEqual(200, first['status'])
+      self.assertEqual(['the', 'cat', 'sat'], first['sequence'])
+      self.assertEqual(400, json.loads(fh.readline())['status'])
+      sock.close()
+    finally:
+      unix_server.shutdown()
+      unix_server.server_close()
+      thread.join()
+      shutil.rmtree(tmpdir)
+
+class PrefixSqlServerTest(unittest.TestCase):
+  def testConnectionPerWorker(self):
+    tmpdir = tempfile.mkdtemp()
+    dbfile = os.path.join(tmpdir, 'chain.db')
+    try:
+      chain = MarkovPrefixSql(max=2, dbfile=dbfile)
+      chain.Update('a b c'.split())
+      chains = []
+      def factory():
+        chains.append(MarkovPrefixSql(max=2, dbfile=dbfile))
+        return chains[-1]
+      srv = server.GenerationServer(factory, workers=3)
+      srv.Start()
+      try:
+        self.assertEqual(3, len(set(id(c._prefixdb) for c in chains)))
+        self.assertEqual(list(chain.GetRandomSequence(['a'])),
+                         srv.Call('generate', {'seed': ['a']})['sequence'])
+      finally:
+        srv.Stop()
+    finally:
+      shutil.rmtree(tmpdir)
+
+if __name__ == "__main__":
+  unittest.main()
@@ -9,7 +9,25 @@ from limited_types import simple_dict as dict
 # from limited_types import list_dict as dict
 from limited_types import simple_tuple as tuple
 
+import math
 import random 
+import sys
+from operator import itemgetter
+from timeit import default_timer as _timer
+
+from random_streams import get_rng
+
+# A metrics.Metrics shared by every chain, or None if metrics are off.
+_metrics = None
+
+def SetMetrics(metrics):
+  """Starts reporting to a metrics.Metrics, or stops if it's None.
+
+  Reports Update() times, how deep each GetRandomTuple() call went, and how
+  many children each _GetRandomElement() call scanned.
+  """
+  global _metrics
+  _metrics = metrics
 
 class _MCLeaf(object):
   """Leaf node on the markov tree
@@ -28,20 +46,21 @@ class _MCLeaf(object):
     self.count=0
     self.labels = set()
 
-  def _UpdateTuple(self, unused_seq, label=None, _labelExclDepth=0):
+  def _UpdateTuple(self, unused_seq, label=None, _labelExclDepth=0, count=1):
     """Update the count and labels, ignore the rest.
 
     Arguments:
       unused_seq: Unused sequence object to match #MarkovChain.Update()
+      count: number of occurrences to add, default = 1
     """
 
     if label is not None and _labelExclDepth <= 0:
       # depending on the uniqeness of the set to remove dupes
       self.labels.add(label)
     
-    self.count += 1
+    self.count += count
 
-  def GetRandomTuple(self, seed, depth, labelset=None):
+  def GetRandomTuple(self, seed, depth, labelset=None, rng=None):
     """ this should never be called """
     raise NotImplementedException()
     return tuple()
@@ -61,7 +80,7 @@ class MarkovChain(dict):
   implementation
   """
 
-  __slots__ = ['count', '_max', '_min', 'labels' ]
+  __slots__ = ['count', '_max', '_min', 'labels', '_sorted' ]
 
   def __init__(self, max=3, min=None):
     """Build a new Markov chain object.
@@ -83,15 +102,22 @@ class MarkovChain(dict):
       raise ValueError("minimum tuple size cannot exceed maximum")
     self._min = min
     self.labels = set()
+    # children sorted by count, built by GetTopK() and cleared on update
+    self._sorted = None
 
   def Update(self, seq, label=None):
     """Updates from a tuple or list, but not an iterator."""
     # this takes care of all the full length subsequences
     # for ind in xrange(len(seq)-self._min+1):
+    metrics = _metrics
+    if metrics is not None:
+      start = _timer()
     for ind in xrange(len(seq)-self._min+1):
       self._UpdateTuple(tuple(seq[ind:ind+self._max]), label=label)
+    if metrics is not None:
+      metrics.RecordTime('tree.Update', _timer() - start)
 
-  def _UpdateTuple(self, t, label=None, _labelExclDepth=None):
+  def _UpdateTuple(self, t, label=None, _labelExclDepth=None, count=1):
     """updates the statistics.
 
     Updates the statistics of this chain wih the supplied tuple.
@@ -100,12 +126,14 @@ class MarkovChain(dict):
       t: a tuple of strings or other elements
       label: A label to associate with this tuple
       _labelExclDepth: Exclude tuples of less than this depth, default = min
+      count: number of occurrences of the tuple to add, default = 1
 
     Retrns:
       Nothing
     """
 
-    self.count += 1
+    self.count += count
+    self._sorted = None
 
     if _labelExclDepth is None:
       _labelExclDepth=self._min
@@ -127,15 +155,19 @@ class MarkovChain(dict):
         self[car] = _MCLeaf()
       else:
         self[car] = MarkovChain(self._max-1) 
-    self[car]._UpdateTuple(cdr, label=label, _labelExclDepth=_labelExclDepth-1)
+    self[car]._UpdateTuple(cdr, label=label, _labelExclDepth=_labelExclDepth-1,
+                           count=count)
 
-  def GetRandomTuple(self, seed=None, depth=None, labelset=None):
+  def GetRandomTuple(self, seed=None, depth=None, labelset=None, rng=None,
+                     _rec_depth=0):
     """Get a random n-tuple based on the seed provided.
 
     Arguments:
       seed: (optional) a seed tuple
       depth: (optional) integer value of the max depth into the tree of the tuple
       labelset: If not None, assumed to be a set of lables involved in this sequence, which will be updated.
+      rng: (optional) random number source or seed, see random_streams.get_rng()
+      _rec_depth: how deep into the tree this call is, for metrics.
 
 
     Returns:
@@ -149,17 +181,22 @@ class MarkovChain(dict):
       depth = self._max
     elif depth > self._max:
       raise ValueError("depth cannot exceed the tree depth")
+    if _rec_depth == 0:
+      # once here, rather than at each level a seed leads down to
+      rng = get_rng(rng)
 
     if depth == 0 or len(self) == 0:
       if labelset is not None:
         labelset |= self.labels
+      if _metrics is not None:
+        _metrics.Observe('tree.GetRandomTuple.depth', _rec_depth)
       return tuple()
 
     if seed:
       retVal = seed[0]
       subSeed = seed[1:]
     else:
-      retVal = self._GetRandomElement()
+      retVal = self._GetRandomElement(rng)
       subSeed = None
 
     if not retVal or retVal not in self:
@@ -167,6 +204,8 @@ class MarkovChain(dict):
       if labelset is not None:
         # since there is nothing down the tree, we'll use this set of labels instead.
         labelset |= self.labels
+      if _metrics is not None:
+        _metrics.Observe('tree.GetRandomTuple.depth', _rec_depth)
       return tuple()
 
     # if we're at the bottom of the tree, we don't recurse,
@@ -174,20 +213,29 @@ class MarkovChain(dict):
     if depth <= 1:
       if labelset is not None:
         labelset |= self[retVal].labels
+      if _metrics is not None:
+        _metrics.Observe('tree.GetRandomTuple.depth', _rec_depth+1)
       return (retVal,)
     else:
     
       return (retVal,) + self[retVal].GetRandomTuple(seed=subSeed,
                                                      depth=depth-1,
-                                                     labelset=labelset)
+                                                     labelset=labelset,
+                                                     rng=rng,
+                                                     _rec_depth=_rec_depth+1)
 
-  def _GetRandomElement(self):
+  def _GetRandomElement(self, rng=random):
     """Find a random element.
 
+    Arguments:
+      rng: source of random numbers, defaults to the random module.
+
     Returns:
       A random element weighted by the distribution, or None if the end condition is hit.
     """
-    target = random.uniform(0,self.count)
+    target = rng.uniform(0,self.count)
+    if _metrics is not None:
+      return self._GetRandomElementCounted(target)
     for (tw,mkv) in self.items():
       if target < mkv.count:
         return tw
@@ -195,7 +243,112 @@ class MarkovChain(dict):
         target -= mkv.count
     return None
 
-  def GetRandomSequence(self, seed=None, depth=None, labelset=None):
+  def _GetRandomElementCounted(self, target):
+    """_GetRandomElement(), reporting how many children it scanned."""
+    for scanned, (tw,mkv) in enumerate(self.items(), 1):
+      if target < mkv.count:
+        _metrics.Observe('tree._GetRandomElement.scanned', scanned)
+        return tw
+      else:
+        target -= mkv.count
+    _metrics.Observe('tree._GetRandomElement.scanned', len(self))
+    return None
+
+  def GetTopK(self, prefix, k):
+    """Find the most likely elements to follow a prefix.
+
+    A prefix shorter than max-1 elements, down to an empty one, gives the
+    elements that follow it in the tuples it starts, counted over all those
+    tuples, as prefix_sql.MarkovPrefixSql.GetTopK() does.
+
+    Arguments:
+      prefix: a tuple of preceding elements, of which only the last max-1
+        are used.
+      k: the maximum number of elements to return.
+
+    Returns:
+      A list of up to k (element, count) tuples, most frequent first.
+
+    Raises:
+      ValueError: if k is negative.
+    """
+    if k < 0:
+      raise ValueError("k cannot be negative")
+    if len(prefix) >= self._max:
+      prefix = prefix[len(prefix)-self._max+1:]
+
+    node = self
+    for element in prefix:
+      if element not in node:
+        return []
+      node = node[element]
+
+    if node._sorted is None:
+      node._sorted = sorted([(element, child.count)
+                             for element, child in node.items()],
+                            key=itemgetter(1), reverse=True)
+    return node._sorted[:k]
+
+  def ScoreSequences(self, seqs, depth=None, per_token=False):
+    """Score sequences by their log-probability under the chain.
+
+    Each element is scored on the depth-1 elements before it, or on all of
+    them for the first few elements of a sequence.  Elements never seen in
+    their context score -inf.  Contexts are looked up once per batch, so
+    batches with many shared contexts are cheap.
+
+    Arguments:
+      seqs: an iterable of sequences to score.
+      depth: The depth of the tree to use for the statistical weightings.
+      per_token: if True, also return the score of each element.
+
+    Returns:
+      A list with the log-probability of each sequence, or, if per_token is
+      set, a list of (log-probability, [element log-probabilities]) tuples.
+
+    Raises:
+      ValueError: if depth > max for the whole tree
+    """
+    if depth is None:
+      depth = self._max
+    elif depth > self._max:
+      raise ValueError("depth cannot exceed the tree depth")
+
+    # maps a context to its node, or None if it was never seen
+    nodes = {(): self}
+    # maps (context, element) to a log-probability
+    scores = {}
+    results = []
+    for seq in seqs:
+      seq = tuple(seq)
+      seq_scores = []
+      for ind in xrange(len(seq)):
+        key = (seq[max(0, ind-depth+1):ind], seq[ind])
+        if key not in scores:
+          node = self._FindNode(key[0], nodes)
+          if node is None or key[1] not in node or not node.count:
+            scores[key] = float('-inf')
+          else:
+            scores[key] = math.log(float(node[key[1]].count) / node.count)
+        seq_scores.append(scores[key])
+
+      if per_token:
+        results.append((sum(seq_scores), seq_scores))
+      else:
+        results.append(sum(seq_scores))
+    return results
+
+  def _FindNode(self, context, nodes):
+    """Finds the node for a context, caching it and its ancestors in nodes."""
+    if context not in nodes:
+      parent = self._FindNode(context[:-1], nodes)
+      if parent is None or context[-1] not in parent:
+        nodes[context] = None
+      else:
+        nodes[context] = parent[context[-1]]
+    return nodes[context]
+
+  def GetRandomSequence(self, seed=None, depth=None, labelset=None, rng=None):
     """Generate a random sequence of elements.
 
     Returns a generator which will return a random sequence
@@ -212,6 +365,8 @@ class MarkovChain(dict):
       labelset: if not none, then it is assumed to be a set to keep track 
         of labels that went into making the sequence. Currently does not
         work for sequences where depth!=max
+      rng: (optional) random number source or seed, see
+        random_streams.get_rng()
 
     Warnings:
       If depth < min+1 the termination point may not be realistic.
@@ -226,6 +381,7 @@ class MarkovChain(dict):
       full_seq_len = depth
     else:
       full_seq_len = self._max
+    rng = get_rng(rng)
 
     if seed and len(seed) >= full_seq_len:
       # if the seed is already longer than a full_seq_length - 1
@@ -237,7 +393,7 @@ class MarkovChain(dict):
       seq = seed[excess:]
     else:
       # Build an initial sequence based on the provided seed.
-      seq = self.GetRandomTuple(seed,depth, labelset=labelset)
+      seq = self.GetRandomTuple(seed,depth, labelset=labelset, rng=rng)
 
     # If the sequence is less than the full length we asked for, then 
     # it means we've reached a natual stopping point and the loop should
@@ -245,7 +401,8 @@ class MarkovChain(dict):
     while len(seq) >= full_seq_len:
       yield seq[0]
       seq = seq[1:]
-      new_seq = self.GetRandomTuple(seq, depth=depth, labelset=labelset)
+      new_seq = self.GetRandomTuple(seq, depth=depth, labelset=labelset,
+                                    rng=rng)
       if new_seq:
         seq = new_seq
 
@@ -262,10 +419,11 @@ class MarkovChain(dict):
     else:
       return self.labels.copy()
 
-  def GetAnnotatedSequence(self, seed=None, depth=None):
+  def GetAnnotatedSequence(self, seed=None, depth=None, rng=None):
 
     if depth is None:
       depth = self._max
+    rng = get_rng(rng)
 
     while seed and len(seed) >= depth:
       seq = seed[:depth]
@@ -274,15 +432,102 @@ class MarkovChain(dict):
       seed = seed[1:]
 
     labelset = set()
-    seq = self.GetRandomTuple(seed, depth=depth, labelset=labelset)
+    seq = self.GetRandomTuple(seed, depth=depth, labelset=labelset, rng=rng)
     while len(seq) >= depth:
       yield seq[0], labelset
       labelset = set()
-      seq = self.GetRandomTuple(seq[1:], depth=depth, labelset=labelset)
+      seq = self.GetRandomTuple(seq[1:], depth=depth, labelset=labelset,
+                                rng=rng)
 
     for element in seq:
       yield element, labelset
 
+  def stats(self, sample=None, rng=None):
+    """Report the size of the tree.
+
+    The tree is walked iteratively, so this works on trees of any size and
+    depth.  For huge trees, only a sample of the root's subtrees can be
+    walked, in which case everything below the root is scaled up to match.
+
+    Arguments:
+      sample: (optional) fraction of the root's subtrees to walk.
+      rng: (optional) random number source or seed for picking the sample,
+        see random_streams.get_rng()
+
+    Returns:
+      A dict with:
+        depths: for each depth from 0 (the root) to max, a dict of the
+          number of nodes, the number of leaves (nodes without children),
+          and a branching histogram mapping a number of children to the
+          number of nodes with that many.
+        nodes, leaves: totals over all depths.
+        labels: number of distinct labels, which isn't scaled up when
+          sampling.
+        label_refs: number of labels attached to nodes, counting repeats.
+        bytes: estimated bytes used by nodes, label sets and elements.
+        sample: the fraction of the tree walked.
+    """
+    if sample is None or sample >= 1:
+      sample = 1.0
+    elif sample <= 0:
+      raise ValueError("sample must be greater than 0")
+    rng = get_rng(rng)
+
+    depths = [{'nodes': 0, 'leaves': 0, 'branching': {}}
+              for _ in xrange(self._max+1)]
+    labels = set()
+    label_refs = 0
+    node_bytes = 0
+    seen_elements = set()
+    element_bytes = 0
+
+    stack = [(self, 0)]
+    while stack:
+      node, depth = stack.pop()
+      stats = depths[depth]
+      stats['nodes'] += 1
+      node_bytes += sys.getsizeof(node) + sys.getsizeof(node.labels)
+      labels.update(node.labels)
+      label_refs += len(node.labels)
+      if not isinstance(node, MarkovChain) or len(node) == 0:
+        stats['leaves'] += 1
+        continue
+
+      branching = len(node)
+      stats['branching'][branching] = stats['branching'].get(branching, 0) + 1
+      for element, child in node.iteritems():
+        if depth == 0 and sample < 1 and rng.random() >= sample:
+          continue
+        if id(element) not in seen_elements:
+          seen_elements.add(id(element))
+          element_bytes += sys.getsizeof(element)
+        stack.append((child, depth+1))
+
+    if sample < 1:
+      # everything but the root was sampled
+      scale = 1 / sample
+      for stats in depths[1:]:
+        stats['nodes'] = int(round(stats['nodes'] * scale))
+        stats['leaves'] = int(round(stats['leaves'] * scale))
+        stats['branching'] = dict((branching, int(round(count * scale)))
+                                  for branching, count
+                                  in stats['branching'].items())
+      root_bytes = sys.getsizeof(self) + sys.getsizeof(self.labels)
+      node_bytes = root_bytes + int(round((node_bytes - root_bytes) * scale))
+      element_bytes = int(round(element_bytes * scale))
+      label_refs = len(self.labels) + int(round(
+          (label_refs - len(self.labels)) * scale))
+
+    return {
+        'depths': depths,
+        'nodes': sum(stats['nodes'] for stats in depths),
+        'leaves': sum(stats['leaves'] for stats in depths),
+        'labels': len(labels),
+        'label_refs': label_refs,
+        'bytes': node_bytes + element_bytes,
+        'sample': sample,
+    }
+
   def PrintTree(self, depth=None, _rec_depth=0):
     if depth is None:
       depth = self._max
@@ -4,8 +4,17 @@
 
 __author__ = 'Mitch Patenaude (patenaude@gmail.com)'
 
+import math
+import random
 import unittest
 
+try:
+  import numpy
+except ImportError:
+  numpy = None
+
+import metrics
+import tree
 from tree import MarkovChain
 from tree import _MCLeaf
 
@@ -106,6 +115,95 @@ class MarkovTest(unittest.TestCase):
     self.assertEqual(0, len(mc['d']['e']),
                      "the final two should have no additional elements")
 
+  def testGetTopK(self):
+    mc = MarkovChain(max=3)
+    for seq in ('abc', 'abc', 'abd', 'xbe'):
+      mc.Update(seq)
+    self.assertEqual([('c', 2), ('d', 1)], mc.GetTopK('ab', 5),
+                     "Top elements not sorted by count")
+    self.assertEqual([('c', 2)], mc.GetTopK('zab', 1),
+                     "Only the last max-1 prefix elements should be used")
+    self.assertEqual([], mc.GetTopK('qq', 3), "Unknown prefix should be empty")
+    self.assertRaises(ValueError, mc.GetTopK, 'ab', -1)
+
+    mc.Update('abd')
+    mc.Update('abd')
+    self.assertEqual([('d', 3)], mc.GetTopK('ab', 1),
+                     "Cached order not invalidated by Update()")
+
+  def testScoreSequences(self):
+    mc = MarkovChain(max=2, min=2)
+    for seq in ('ab', 'ab', 'ac', 'bc'):
+      mc.Update(seq)
+    scores = mc.ScoreSequences(['abc', 'ad'], per_token=True)
+    self.assertAlmostEqual(math.log(3.0/4) + math.log(2.0/3) + math.log(1.0),
+                           scores[0][0])
+    self.assertEqual(3, len(scores[0][1]), "Should score every element")
+    self.assertEqual(float('-inf'), scores[1][0],
+                     "Unseen transition should have zero probability")
+    self.assertEqual([scores[0][0]], mc.ScoreSequences(['abc']))
+
+  def testSeededSequence(self):
+    mc = MarkovChain(max=2)
+    mc.Update('abacabadabacaba')
+    first = ''.join(mc.GetRandomSequence(('a',), rng=99))
+    second = ''.join(mc.GetRandomSequence(('a',), rng=random.Random(99)))
+    self.assertEqual(first, second,
+                     "The same seed should give the same sequence")
+
+  def testNumpySequence(self):
+    if numpy is None:
+      self.skipTest('numpy is not installed')
+    mc = MarkovChain(max=2)
+    mc.Update('abacabadabacaba')
+    first = ''.join(mc.GetRandomSequence(('a',),
+                                         rng=numpy.random.RandomState(4)))
+    second = ''.join(mc.GetRandomSequence(('a',),
+                                          rng=numpy.random.RandomState(4)))
+    self.assertEqual(first, second,
+                     "The same RandomState should give the same sequence")
+    self.assertEqual('a', first[0])
+    self.assertEqual(set(), set(first) - set('abcd'))
+
+  def testMetrics(self):
+    m = metrics.Metrics()
+    tree.SetMetrics(m)
+    try:
+      mc = MarkovChain(max=3)
+      mc.Update('abcabd')
+      mc.GetRandomTuple(('a',))
+      mc.GetRandomTuple()
+    finally:
+      tree.SetMetrics(None)
+    mc.GetRandomTuple()
+
+    snapshot = m.Snapshot()
+    self.assertEqual(1, snapshot['counters']['tree.Update.calls'])
+    depths = snapshot['histograms']['tree.GetRandomTuple.depth']
+    self.assertEqual(2, depths['count'],
+                     "Should record one depth per call while enabled")
+    self.assertEqual(3, depths['max'])
+    self.assertTrue('tree._GetRandomElement.scanned' in snapshot['histograms'])
+
+  def testStats(self):
+    mc = MarkovChain(max=3)
+    mc.Update('abcd', label='first')
+    mc.Update('abce', label='second')
+    stats = mc.stats()
+    self.assertEqual(2, stats['labels'])
+    # a b c, ab bc cd ce, abc bcd bce
+    self.assertEqual([1, 3, 4, 3], [d['nodes'] for d in stats['depths']])
+    self.assertEqual({3: 1}, stats['depths'][0]['branching'])
+    self.assertEqual({1: 1, 2: 1}, stats['depths'][2]['branching'])
+    self.assertEqual(2, stats['depths'][2]['leaves'])
+    self.assertEqual(11, stats['nodes'])
+    self.assertTrue(stats['bytes'] > 0)
+
+    sampled = mc.stats(sample=0.5, rng=1)
+    self.assertEqual(0.5, sampled['sample'])
+    self.assertEqual(1, sampled['depths'][0]['nodes'],
+                     "The root should never be scaled")
+
   def testMinDepthAutoSet(self):
     mc = MarkovChain(max=6)
     self.assertEqual(5, mc._min, "Min value should have a default of max-1")
@@ -0,0 +1,429 @@
+#!/usr/bin/python
+
+"""A flat representation of a markov chain.
+
+Rather than a tree with a node for every prefix, each tuple is filed under
+its first max-1 elements (its context) in a single dict, and each context
+maps to a compact table of the elements that followed it, with their
+counts.  A tuple shorter than max (the tail end of a sequence) is filed
+under the whole tuple, followed by an end marker.
+
+The common generation step, picking the element to follow max-1 elements,
+is a single dict lookup.  Lookups on fewer elements (no seed, a short seed,
+or a depth below max) go through a sorted list of the contexts with running
+totals, which is rebuilt the first time it's needed after an update.
+"""
+
+from array import array
+import bisect
+import random
+
+from random_streams import get_rng
+
+# Marks the end of a sequence in a successor table.
+_END = None
+
+
+class _Last(object):
+  """Sorts after every element, to find the end of a range of contexts."""
+
+  def __lt__(self, other):
+    return False
+
+  def __gt__(self, other):
+    return other is not self
+
+_LAST = _Last()
+
+
+class _Successors(object):
+  """The elements seen after one context, and how many times each was seen.
+
+  Tables with fewer than WIDE_TABLE elements are searched in order, which is
+  quick for such short lists and saves memory; wider ones get a dict from
+  element to position.
+  """
+
+  __slots__ = ['total', 'elements', 'counts', 'index']
+
+  WIDE_TABLE = 8
+
+  def __init__(self):
+    self.total = 0
+    self.elements = []
+    self.counts = array('L')
+    self.index = None
+
+  def __getstate__(self):
+    # the index is cheaper to rebuild than to save
+    return self.total, self.elements, self.counts
+
+  def __setstate__(self, state):
+    self.total, self.elements, self.counts = state
+    self.index = None
+
+  def _Slot(self, element):
+    """Returns the position of element in the table, or None."""
+    index = self.index
+    if index is None:
+      if len(self.elements) < self.WIDE_TABLE:
+        try:
+          return self.elements.index(element)
+        except ValueError:
+          return None
+      index = self.index = dict((element, ind) for ind, element
+                                in enumerate(self.elements))
+    return index.get(element)
+
+  def Add(self, element, count=1):
+    self.total += count
+    ind = self._Slot(element)
+    if ind is None:
+      if self.index is not None:
+        self.index[element] = len(self.elements)
+      self.elements.append(element)
+      self.counts.append(count)
+    else:
+      self.counts[ind] += count
+
+  def Count(self, element):
+    ind = self._Slot(element)
+    return 0 if ind is None else self.counts[ind]
+
+  def GetRandomElement(self, rng=random):
+    """Returns an element weighted by count, or _END."""
+    target = rng.uniform(0, self.total)
+    for ind, count in enumerate(self.counts):
+      if target < count:
+        return self.elements[ind]
+      target -= count
+    return _END
+
+
+class MarkovChain(object):
+  """A flat map representation of a markov chain.
+
+  This has the same interface as tree.MarkovChain, but uses much less
+  memory, since there is one dict entry per distinct max-1 element context
+  instead of a dict for every prefix of every tuple.
+  """
+
+  def __init__(self, max=3, min=None):
+    """Build a new Markov chain object.
+
+    Arguments:
+     max: maximum length of tuple to keep stats for. (optional, default = 3)
+     min: minimum length of tuple about which statistics will be updated by
+       the Update() method.  See tree.MarkovChain.
+    """
+    self.count = 0
+    self._max = max
+    if min is None:
+      min = max-1
+    elif min > max:
+      raise ValueError("minimum tuple size cannot exceed maximum")
+    self._min = min
+    self.labels = set()
+
+    self._contexts = {}
+    # one copy of each element, shared by every context holding it
+    self._elements = {}
+    # labels of every tuple other than the empty one, only kept if used
+    self._node_labels = {}
+    # sorted contexts and running totals, built by _SortedContexts()
+    self._sorted = None
+
+  def _Intern(self, element):
+    return self._elements.setdefault(element, element)
+
+  def Update(self, seq, label=None):
+    """Updates from a tuple or list, but not an iterator."""
+    for ind in xrange(len(seq)-self._min+1):
+      self._UpdateTuple(seq[ind:ind+self._max], label=label)
+
+  def _UpdateTuple(self, t, label=None, count=1):
+    """Updates the statistics with the supplied tuple.
+
+    Arguments:
+      t: a tuple of at most max elements
+      label: A label to associate with this tuple
+      count: number of occurrences of the tuple to add, default = 1
+    """
+    t = tuple([self._Intern(element) for element in t])
+    self.count += count
+    self._sorted = None
+
+    if len(t) >= self._max:
+      context, element = t[:self._max-1], t[self._max-1]
+    else:
+      context, element = t, _END
+
+    successors = self._contexts.get(context)
+    if successors is None:
+      successors = self._contexts[context] = _Successors()
+    successors.Add(element, count)
+
+    if label is not None:
+      if self._min <= 0 or not t:
+        self.labels.add(label)
+      for depth in xrange(self._min if self._min > 1 else 1, len(t)+1):
+        node = t[:depth]
+        if node not in self._node_labels:
+          self._node_labels[node] = set()
+        self._node_labels[node].add(label)
+
+  def Merge(self, other):
+    """Adds the statistics of another chain with the same max and min.
+
+    Merging the chains trained on consecutive parts of a corpus, in order,
+    gives the same chain as training on the whole corpus.
+    """
+    if (other._max, other._min) != (self._max, self._min):
+      raise ValueError('can only merge chains with the same max and min')
+    self.count += other.count
+    self._sorted = None
+    self.labels |= other.labels
+    for context, successors in other._contexts.iteritems():
+      context = tuple([self._Intern(element) for element in context])
+      mine = self._contexts.get(context)
+      if mine is None:
+        mine = self._contexts[context] = _Successors()
+      for element, count in zip(successors.elements, successors.counts):
+        if element is not _END:
+          element = self._Intern(element)
+        mine.Add(element, count)
+    for node, labels in other._node_labels.iteritems():
+      node = tuple([self._Intern(element) for element in node])
+      if node not in self._node_labels:
+        self._node_labels[node] = set()
+      self._node_labels[node] |= labels
+
+  def __getstate__(self):
+    # the sorted contexts are cheaper to rebuild than to save
+    state = self.__dict__.copy()
+    state['_sorted'] = None
+    return state
+
+  def _SortedContexts(self):
+    if self._sorted is None:
+      contexts = sorted(self._contexts)
+      totals = array('L')
+      total = 0
+      for context in contexts:
+        total += self._contexts[context].total
+        totals.append(total)
+      self._sorted = (contexts, totals)
+    return self._sorted
+
+  def _ContextRange(self, prefix):
+    """Returns the (lo, hi) range of sorted contexts that start with prefix."""
+    contexts, _ = self._SortedContexts()
+    if not prefix:
+      return 0, len(contexts)
+    return (bisect.bisect_left(contexts, prefix),
+            bisect.bisect_left(contexts, prefix + (_LAST,)))
+
+  def _Has(self, node):
+    """Returns whether the tuple node has been seen."""
+    if len(node) >= self._max:
+      successors = self._contexts.get(node[:self._max-1])
+      return successors is not None and successors.Count(node[self._max-1]) > 0
+    if node in self._contexts:
+      return True
+    lo, hi = self._ContextRange(node)
+    return lo < hi
+
+  def _GetRandomContext(self, prefix, rng):
+    """Returns a random context starting with prefix, weighted by count."""
+    contexts, totals = self._SortedContexts()
+    lo, hi = self._ContextRange(prefix)
+    if lo >= hi:
+      return None
+    start = totals[lo-1] if lo else 0
+    ind = bisect.bisect_right(totals, rng.uniform(start, totals[hi-1]), lo, hi)
+    if ind >= hi:
+      return None
+    return contexts[ind]
+
+  def _NodeLabels(self, node):
+    if not node:
+      return self.labels
+    return self._node_labels.get(node, ())
+
+  def GetRandomTuple(self, seed=None, depth=None, labelset=None, rng=None):
+    """Get a random n-tuple based on the seed provided.
+
+    Arguments:
+      seed: (optional) a seed tuple
+      depth: (optional) integer value of the max depth into the tree of the tuple
+      labelset: If not None, assumed to be a set of lables involved in this
+        sequence, which will be updated.
+      rng: (optional) random number source or seed, see
+        random_streams.get_rng()
+
+    Returns:
+      a tuple based on the seed and the distribution in the chain
+
+    Raises:
+      ValueError: if depth > max for the whole chain
+    """
+    if depth is None:
+      depth = self._max
+    elif depth > self._max:
+      raise ValueError("depth cannot exceed the tree depth")
+    seed = tuple(seed[:depth]) if seed else ()
+
+    # usually the seed is a whole context, which takes a single lookup
+    width = self._max - 1
+    if len(seed) >= width and seed[:width] in self._contexts:
+      node, rest = seed[:width], seed[width:]
+    else:
+      node, rest = (), seed
+
+    for element in rest:
+      if not self._Has(node + (element,)):
+        break
+      node += (element,)
+    else:
+      if len(node) < depth:
+        rng = get_rng(rng)
+        if len(node) < width:
+          # picking a whole context by count is the same as picking one
+          # element at a time from the prefix counts
+          context = self._GetRandomContext(node, rng)
+          if context is not None:
+            node = context[:depth]
+        if len(node) == width and depth == self._max:
+          element = self._contexts[node].GetRandomElement(rng)
+          if element is not _END:
+            node += (element,)
+
+    if labelset is not None:
+      labelset.update(self._NodeLabels(node))
+    return node
+
+  def GetRandomSequence(self, seed=None, depth=None, labelset=None, rng=None):
+    """Generate a random sequence of elements.
+
+    See tree.MarkovChain.GetRandomSequence() for details.
+
+    Returns:
+      An iterable sequence of elements.
+    """
+    if depth is not None:
+      full_seq_len = depth
+    else:
+      full_seq_len = self._max
+    rng = get_rng(rng)
+
+    if seed and len(seed) >= full_seq_len:
+      excess = len(seed) - full_seq_len
+      for ind in xrange(0,excess):
+        yield seed[ind]
+      seq = tuple(seed[excess:])
+    else:
+      seq = self.GetRandomTuple(seed, depth, labelset=labelset, rng=rng)
+
+    while len(seq) >= full_seq_len:
+      yield seq[0]
+      seq = seq[1:]
+      new_seq = self.GetRandomTuple(seq, depth=depth, labelset=labelset,
+                                    rng=rng)
+      if new_seq:
+        seq = new_seq
+
+    for element in seq:
+      yield element
+
+  def _GetLabels(self, seq):
+    seq = tuple(seq)
+    if seq and not self._Has(seq):
+      return None
+    return set(self._NodeLabels(seq))
+
+  def GetAnnotatedSequence(self, seed=None, depth=None, rng=None):
+
+    if depth is None:
+      depth = self._max
+    rng = get_rng(rng)
+
+    while seed and len(seed) >= depth:
+      seq = seed[:depth]
+      labelset = self._GetLabels(seq)
+      yield seq[0], labelset
+      seed = seed[1:]
+
+    labelset = set()
+    seq = self.GetRandomTuple(seed, depth=depth, labelset=labelset, rng=rng)
+    while len(seq) >= depth:
+      yield seq[0], labelset
+      labelset = set()
+      seq = self.GetRandomTuple(seq[1:], depth=depth, labelset=labelset,
+                                rng=rng)
+
+    for element in seq:
+      yield element, labelset
+
+
+def _DeepSizeOf(obj):
+  """Estimates the bytes used by obj and everything it refers to."""
+  import sys
+  seen = set()
+  stack = [obj]
+  size = 0
+  while stack:
+    obj = stack.pop()
+    if id(obj) in seen:
+      continue
+    seen.add(id(obj))
+    size += sys.getsizeof(obj)
+    if isinstance(obj, dict):
+      stack.extend(obj.keys())
+      stack.extend(obj.values())
+    elif isinstance(obj, (list, tuple, set, frozenset)):
+      stack.extend(obj)
+    if hasattr(obj, '__dict__'):
+      stack.append(obj.__dict__)
+    for cls in type(obj).__mro__:
+      for slot in getattr(cls, '__slots__', ()):
+        if hasattr(obj, slot):
+          stack.append(getattr(obj, slot))
+  return size
+
+
+if __name__ == '__main__':
+  # Compares memory and speed with tree.MarkovChain:
+  #   tuple_map.py [max] [files...]
+  # With no files, a synthetic corpus of 200k words is used.
+  import sys
+  import time
+  import tree
+
+  max = int(sys.argv[1]) if len(sys.argv) > 1 else 3
+  if len(sys.argv) > 2:
+    paras = [open(f).read().split() for f in sys.argv[2:]]
+  else:
+    # roughly Zipfian word frequencies
+    rnd = random.Random(0)
+    vocab = ['w%d' % i for i in xrange(5000)]
+    paras = [[vocab[min(int(rnd.paretovariate(1.0)), len(vocab)) - 1]
+              for _ in xrange(100)]
+             for _ in xrange(2000)]
+
+  for name, chain in (('tree', tree.MarkovChain(max=max)),
+                      ('tuple_map', MarkovChain(max=max))):
+    start = time.time()
+    for para in paras:
+      chain.Update(para)
+    update_time = time.time() - start
+
+    rng = random.Random(1)
+    generated = 0
+    start = time.time()
+    for para in paras:
+      for _ in chain.GetRandomSequence(tuple(para[:max-1]), rng=rng):
+        generated += 1
+    generate_time = time.time() - start
+
+    print('{:10} {:8.1f} MB  update {:6.2f}s  generate {:6.2f}s ({} elements)'.format(
+        name, _DeepSizeOf(chain) / 1e6, update_time, generate_time, generated))
@@ -0,0 +1,114 @@
+#!/usr/bin/python
+
+import pickle
+import random
+import unittest
+
+from tuple_map import MarkovChain
+import tree
+
+class TupleMapTest(unittest.TestCase):
+  def _NodeCount(self, mc, node):
+    if len(node) == mc._max:
+      return mc._contexts[node[:-1]].Count(node[-1])
+    lo, hi = mc._ContextRange(node)
+    totals = mc._SortedContexts()[1]
+    return totals[hi-1] - (totals[lo-1] if lo else 0)
+
+  def testMarkovChainInit(self):
+    mc = MarkovChain(max=3)
+    self.assertEqual(0, mc.count, "Nonzero count in fresh instance")
+    self.assertEqual(tuple(), mc.GetRandomTuple(),
+                    "Empty chain should return an empty tuple.")
+    self.assertEqual(3, mc._max, "max tuple length not set properly")
+    self.assertEqual(2, mc._min, "Min value should have a default of max-1")
+
+  def testChainUpdate(self):
+    mc = MarkovChain(max=3)
+    mc.Update('abc', label='first')
+    retSeq = mc.GetRandomTuple(('a',))
+    self.assertEqual(('a','b','c',), retSeq, "Initial Tuple not recovered with"
+                     " appropriate seed: got %s" % repr(retSeq))
+    self.assertTrue(mc.GetRandomTuple() in (('a','b','c'), ('b','c')),
+                    "Didn't get an extant tuple back")
+    self.assertEqual(('a',), mc.GetRandomTuple(('a', 'x')),
+                     "Unseen seed should stop where it leaves the chain")
+    fullSeq = ''.join(mc.GetRandomSequence(('a',)))
+    self.assertEqual('abc', fullSeq, "Didn't full full sequence"
+                     " back out, only %s" % fullSeq)
+    self.assertEqual([('a', set(['first'])), ('b', set(['first'])),
+                      ('c', set(['first']))],
+                     list(mc.GetAnnotatedSequence('ab')))
+
+  def testMinDepthUpdates(self):
+    mc = MarkovChain(max=4,min=2)
+    mc.Update('abcde')
+    self.assertEqual(('d', 'e'), mc.GetRandomTuple(('d',)),
+                     "Final two should be in the chain")
+    self.assertEqual((), mc.GetRandomTuple(('e',)),
+                     "Last element should not be at the head of a chain")
+
+  def testCountsMatchTree(self):
+    rnd = random.Random(1234)
+    words = [rnd.choice(['the', 'cat', 'sat', 'on', 'mat', 'a'])
+             for _ in xrange(500)]
+    fmc = MarkovChain(max=4, min=2)
+    tmc = tree.MarkovChain(max=4, min=2)
+    for para in (words[:200], words[200:], ['the']):
+      fmc.Update(para)
+      tmc.Update(para)
+
+    self.assertEqual(tmc.count, fmc.count)
+    stack = [(tmc, ())]
+    while stack:
+      node, path = stack.pop()
+      if len(path) == tmc._max:
+        continue
+      for element, child in node.items():
+        self.assertEqual(child.count, self._NodeCount(fmc, path + (element,)),
+                         "Count mismatch for %r" % (path + (element,),))
+        stack.append((child, path + (element,)))
+
+  def testMerge(self):
+    words = 'the cat sat on the mat and the cat ran'.split()
+    whole = MarkovChain(max=3)
+    whole.Update(words[:5])
+    whole.Update(words[5:])
+    first, second = MarkovChain(max=3), MarkovChain(max=3)
+    first.Update(words[:5])
+    second.Update(words[5:])
+    first.Merge(second)
+    self.assertEqual(whole.count, first.count)
+    for context, successors in whole._contexts.items():
+      merged = first._contexts[context]
+      self.assertEqual(successors.elements, merged.elements,
+                       "Merge should keep the order elements were first seen")
+      self.assertEqual(list(successors.counts), list(merged.counts))
+    self.assertRaises(ValueError, first.Merge, MarkovChain(max=2))
+
+  def testWideContext(self):
+    mc = MarkovChain(max=2)
+    seq = []
+    for ind in xrange(20):
+      seq.extend(['the', 'w%d' % (ind % 10)])
+    mc.Update(seq)
+    successors = mc._contexts[('the',)]
+    self.assertNotEqual(None, successors.index,
+                        "Wide tables should be indexed")
+    self.assertEqual(2, successors.Count('w3'))
+    self.assertEqual(0, successors.Count('w10'))
+    restored = pickle.loads(pickle.dumps(mc, pickle.HIGHEST_PROTOCOL))
+    restored.Update(['the', 'w3'])
+    self.assertEqual(3, restored._contexts[('the',)].Count('w3'))
+    self.assertEqual(10, len(restored._contexts[('the',)].elements))
+
+  def testSeededSequence(self):
+    mc = MarkovChain(max=2)
+    mc.Update('abacabadabacaba')
+    first = ''.join(mc.GetRandomSequence(rng=99))
+    second = ''.join(mc.GetRandomSequence(rng=random.Random(99)))
+    self.assertEqual(first, second,
+                     "The same seed should give the same sequence")
+
+if __name__ == "__main__":
+  unittest.main()